@@ -0,0 +1,66 @@
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from redis.exceptions import ResponseError
+from django.conf import settings
+from django.utils import timezone
+from .clients import get_redis
+from .conditional import invalidate_profiles
+from .models import User
+
+# Activity is noted in Redis instead of on the User row: a HyperLogLog of user
+# ids per day for active-user counts, and a hash of last-seen timestamps that
+# flush_last_seen() writes back to User.last_login in bulk.
+DAILY_USERS_KEY = 'activity:users:{day}'
+LAST_SEEN_KEY = 'activity:last_seen'
+FLUSHING_KEY = 'activity:last_seen:flushing'
+
+_recent = {}
+_recent_lock = threading.Lock()
+
+
+def record_activity(user_id):
+    """Note that the user is active. Cheap enough to call on every request."""
+    now = time.monotonic()
+    with _recent_lock:
+        # Each process writes a given user at most once per interval
+        if now - _recent.get(user_id, float('-inf')) < settings.ACTIVITY_RECORD_INTERVAL:
+            return
+        if len(_recent) >= settings.ACTIVITY_RECENT_MAX_ENTRIES:
+            _recent.clear()
+        _recent[user_id] = now
+
+    seen_at = timezone.now()
+    daily_key = DAILY_USERS_KEY.format(day=timezone.localdate(seen_at).isoformat())
+    pipeline = get_redis().pipeline(transaction=False)
+    pipeline.pfadd(daily_key, user_id)
+    pipeline.expire(daily_key, settings.ACTIVITY_RETENTION_DAYS * 24 * 60 * 60)
+    pipeline.hset(LAST_SEEN_KEY, user_id, int(seen_at.timestamp()))
+    pipeline.execute()
+
+
+def count_active_users(day):
+    """Approximate number of distinct users active on a (local) date"""
+    return get_redis().pfcount(DAILY_USERS_KEY.format(day=day.isoformat()))
+
+
+def flush_last_seen():
+    """Write pending last-seen timestamps to User.last_login. Returns users updated."""
+    redis_client = get_redis()
+
+    # A crashed flush leaves its batch behind; finish that one first
+    if not redis_client.exists(FLUSHING_KEY):
+        try:
+            redis_client.rename(LAST_SEEN_KEY, FLUSHING_KEY)
+        except ResponseError:
+            return 0  # nothing recorded since the last flush
+
+    seen = redis_client.hgetall(FLUSHING_KEY)
+    users = [
+        User(pk=int(user_id), last_login=datetime.fromtimestamp(int(timestamp), tz=dt_timezone.utc))
+        for user_id, timestamp in seen.items()
+    ]
+    User.objects.bulk_update(users, ['last_login'], batch_size=settings.ACTIVITY_FLUSH_BATCH_SIZE)
+    invalidate_profiles([user.pk for user in users])
+    redis_client.delete(FLUSHING_KEY)
+    return len(users)
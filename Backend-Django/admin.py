@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Child, Question, Payment, Subscription
+from .models import User, Child, Question, Payment, Subscription, DailyUsageRollup, Notification
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -26,10 +26,10 @@ class ChildAdmin(admin.ModelAdmin):
 
 @admin.register(Question)
 class QuestionAdmin(admin.ModelAdmin):
-    list_display = ['question_id', 'user', 'subject', 'grade_level', 'type', 'is_processed', 'rating', 'cost', 'created_at']
+    list_display = ['question_id', 'user', 'subject', 'grade_level', 'type', 'plan', 'is_processed', 'rating', 'cost', 'created_at']
     list_filter = ['type', 'subject', 'grade_level', 'difficulty', 'is_processed', 'created_at']
     search_fields = ['user__email', 'subject', 'content']
-    readonly_fields = ['question_id', 'processing_time', 'created_at', 'updated_at']
+    readonly_fields = ['question_id', 'processing_time', 'prompt_tokens', 'completion_tokens', 'created_at', 'updated_at']
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
@@ -45,85 +45,105 @@ class SubscriptionAdmin(admin.ModelAdmin):
     search_fields = ['user__email']
     readonly_fields = ['start_date']
 
+@admin.register(DailyUsageRollup)
+class DailyUsageRollupAdmin(admin.ModelAdmin):
+    list_display = ['day', 'subject', 'grade_level', 'plan', 'questions', 'unique_users', 'revenue', 'average_processing_time']
+    list_filter = ['plan', 'subject', 'grade_level']
+    date_hierarchy = 'day'
+    readonly_fields = [field.name for field in DailyUsageRollup._meta.fields]
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ['recipient', 'channel', 'subject', 'status', 'attempts', 'created_at', 'sent_at']
+    list_filter = ['channel', 'status', 'created_at']
+    search_fields = ['recipient', 'dedupe_key']
+    readonly_fields = ['dedupe_key', 'created_at', 'claimed_at', 'sent_at']
+
 # ================================
 # management/commands/process_expired_subscriptions.py
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from homework_helper.models import User, Subscription
+from homework_helper.tasks import process_expired_subscriptions
 
 class Command(BaseCommand):
     help = 'Process expired subscriptions'
 
     def handle(self, *args, **options):
-        now = timezone.now()
-        expired_subscriptions = Subscription.objects.filter(
-            end_date__lt=now,
-            status='active'
-        )
+        # Same chunked sweep the beat schedule runs, executed in this process
+        totals = process_expired_subscriptions()
         
-        for subscription in expired_subscriptions:
-            subscription.status = 'expired'
-            subscription.save()
-            
-            # Update user subscription status
-            user = subscription.user
-            user.subscription_type = 'free'
-            user.subscription_status = 'expired'
-            user.credits = 0  # Reset credits for expired users
-            user.save()
-            
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'Processed expired subscription for {user.email}'
-                )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Expired {totals['subscriptions']} subscriptions, "
+                f"moved {totals['users']} users to the free plan"
             )
+        )
 
 # ================================
 # management/commands/send_subscription_reminders.py
 from django.core.management.base import BaseCommand
-from django.core.mail import send_mail
-from django.conf import settings
-from django.utils import timezone
-from datetime import timedelta
-from homework_helper.models import User, Subscription
+from homework_helper.tasks import send_subscription_reminders
 
 class Command(BaseCommand):
     help = 'Send subscription renewal reminders'
 
     def handle(self, *args, **options):
-        # Send reminders 3 days before expiry
-        reminder_date = timezone.now() + timedelta(days=3)
-        
-        upcoming_expiries = Subscription.objects.filter(
-            end_date__date=reminder_date.date(),
-            status='active',
-            auto_renew=False
-        )
+        # Reminders are queued in batches for the mail workers to send
+        queued = send_subscription_reminders()
         
-        for subscription in upcoming_expiries:
-            user = subscription.user
-            
-            send_mail(
-                subject='Homework Helper Subscription Reminder',
-                message=f'''
-                Hi {user.first_name},
-                
-                Your Homework Helper subscription will expire on {subscription.end_date.strftime('%B %d, %Y')}.
-                
-                Don't miss out on getting help with your children's homework!
-                
-                Renew your subscription now to continue enjoying unlimited questions and expert explanations.
-                
-                Best regards,
-                The Homework Helper Team
-                ''',
-                from_email=settings.EMAIL_HOST_USER,
-                recipient_list=[user.email],
-                fail_silently=False,
-            )
-            
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'Sent reminder to {user.email}'
-                )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Queued {queued} reminders'
             )
+        )
+
+# ================================
+# management/commands/bench_credit_spend.py
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from homework_helper import credits
+from homework_helper.models import User, CreditTransaction
+
+class Command(BaseCommand):
+    help = 'Fire parallel credit spends at one account and check the ledger stays consistent'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--threads', type=int, default=50)
+        parser.add_argument('--credits', type=int, default=200)
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(
+            email='credit-bench@homeworkhelper.com',
+            defaults={'username': 'credit-bench', 'phone': '+254700000000'}
+        )
+        CreditTransaction.objects.filter(user=user).delete()
+        user.credits = options['credits']
+        user.save(update_fields=['credits'])
+
+        def submit(_):
+            try:
+                return credits.spend(user.id)
+            finally:
+                connection.close()
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            results = list(executor.map(submit, range(options['requests'])))
+        elapsed = time.time() - start
+
+        accepted = sum(results)
+        expected = min(options['credits'], options['requests'])
+        live_balance = credits.get_balance(user.id)
+        credits.forget_balance(user.id)
+        stored_balance = credits.get_balance(user.id)
+
+        self.stdout.write(
+            f"{options['requests']} spends on {options['threads']} threads in {elapsed:.2f}s "
+            f"({options['requests'] / elapsed:.0f}/s): {accepted} accepted, "
+            f"live balance {live_balance}, ledger balance {stored_balance}"
+        )
+        if accepted != expected or live_balance != stored_balance or live_balance < 0:
+            raise CommandError('Credit ledger is inconsistent')
+        self.stdout.write(self.style.SUCCESS('Credit ledger is consistent'))
@@ -0,0 +1,111 @@
+import hashlib
+import re
+import unicodedata
+from django.conf import settings
+from django.core.cache import caches
+
+# Characters that change the meaning of a question and must survive folding
+MATH_CHARACTERS = set('+-*/=^%<>()[]!')
+
+# Prose punctuation that never changes what is being asked
+PROSE_PUNCTUATION = set('?¿¡"\'`‘’‚“”„«»‹›…')
+
+# Separators that matter between operands ("2:3", "(1,2)", "0.5") but not
+# at the end of a clause ("Solve: x+1=2", "Hello, what is 2+2.")
+SEPARATORS = set('.,;:')
+
+SYMBOL_REPLACEMENTS = {
+    '×': '*',  # multiplication sign
+    '·': '*',  # middle dot, as in x·y
+    '÷': '/',  # division sign
+    '−': '-',  # minus sign
+    '–': '-',
+    '—': '-',
+}
+
+NUMBER_RE = re.compile(r'(?<![\w.])(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d+))?(?![\w])')
+WHITESPACE_RE = re.compile(r'\s+')
+OPERATOR_SPACING_RE = re.compile(r'\s*([+\-*/=^%<>()\[\]!])\s*')
+
+
+def _normalize_number(match):
+    whole = match.group(1).replace(',', '').lstrip('0') or '0'
+    fraction = (match.group(2) or '').rstrip('0')
+    return f"{whole}.{fraction}" if fraction else whole
+
+
+def _fold_punctuation(text):
+    folded = []
+    for index, char in enumerate(text):
+        if char in PROSE_PUNCTUATION:
+            folded.append(' ')
+        elif char in SEPARATORS:
+            before = text[index - 1] if index else ' '
+            after = text[index + 1] if index + 1 < len(text) else ' '
+            # Decimal points (".5") and separators between operands stay
+            between = (before.isalnum() or before in ')]') and (after.isalnum() or after in '([')
+            folded.append(char if between or (char == '.' and after.isdigit()) else ' ')
+        else:
+            folded.append(char)
+    return ''.join(folded)
+
+
+def normalize_text(text):
+    """Fold whitespace, case, prose punctuation and number formatting"""
+    text = unicodedata.normalize('NFKC', text or '')
+    for symbol, replacement in SYMBOL_REPLACEMENTS.items():
+        text = text.replace(symbol, replacement)
+    text = NUMBER_RE.sub(_normalize_number, text.lower())
+    text = _fold_punctuation(text)
+    text = OPERATOR_SPACING_RE.sub(r'\1', text)
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+
+def question_fingerprint(content, subject, grade_level):
+    raw = '|'.join([normalize_text(subject), normalize_text(grade_level), normalize_text(content)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """Shared cache of AI answers keyed on a normalized question fingerprint"""
+
+    HITS_KEY = 'stats:hits'
+    MISSES_KEY = 'stats:misses'
+
+    def __init__(self):
+        self.cache = caches[settings.ANSWER_CACHE_ALIAS]
+        self.timeout = settings.ANSWER_CACHE_TIMEOUT
+
+    def get(self, content, subject, grade_level, image_digest=None):
+        response = self.cache.get(self._key(content, subject, grade_level, image_digest))
+        self._count(self.HITS_KEY if response is not None else self.MISSES_KEY)
+        return response
+
+    def set(self, content, subject, grade_level, response, image_digest=None):
+        self.cache.set(self._key(content, subject, grade_level, image_digest), response, self.timeout)
+
+    def stats(self):
+        counters = self.cache.get_many([self.HITS_KEY, self.MISSES_KEY])
+        hits = counters.get(self.HITS_KEY, 0)
+        misses = counters.get(self.MISSES_KEY, 0)
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _key(self, content, subject, grade_level, image_digest=None):
+        fingerprint = question_fingerprint(content, subject, grade_level)
+        if image_digest:
+            # Same photo, same subject and grade, same accompanying text
+            return f"image:{image_digest}:{fingerprint}"
+        return f"question:{fingerprint}"
+
+    def _count(self, key):
+        self.cache.add(key, 0, timeout=None)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # Counter was evicted between add() and incr()
+            self.cache.set(key, 1, timeout=None)
@@ -0,0 +1,86 @@
+import json
+import re
+
+# Models are asked for a JSON object; parse_answer() also copes with code
+# fences, chatter around the object, and plain prose (used for streamed answers).
+DIFFICULTIES = ('easy', 'medium', 'hard')
+SUMMARY_MAX_LENGTH = 200
+
+FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$', re.IGNORECASE)
+STEP_LINE_RE = re.compile(r'^\s*(?:step\s*)?(\d+)\s*[.):-]\s*(.+)$', re.IGNORECASE | re.MULTILINE)
+DIFFICULTY_RE = re.compile(r'difficulty\W{0,5}(easy|medium|hard)', re.IGNORECASE)
+DIFFICULTY_LINE_RE = re.compile(r'^.*difficulty\W{0,5}(?:easy|medium|hard)\W*$', re.IGNORECASE | re.MULTILINE)
+SENTENCE_RE = re.compile(r'(?<=[.!?])\s')
+BLANK_LINES_RE = re.compile(r'\n\s*\n+')
+
+
+def parse_answer(text, default_difficulty='medium'):
+    """Split a completion into the explanation, summary, steps and difficulty"""
+    text = (text or '').strip()
+    data = _load_json(text)
+    if data is None:
+        return _parse_prose(text, default_difficulty)
+
+    explanation = _text(data.get('explanation'))
+    tip = _text(data.get('tip'))
+    if tip:
+        explanation = f"{explanation}\n\nTip for parents: {tip}".strip()
+    steps = [_text(step.get('description') if isinstance(step, dict) else step) for step in _list(data.get('steps'))]
+    steps = [step for step in steps if step]
+    summary = _text(data.get('summary')) or _summarize(explanation)
+
+    return {
+        'explanation': explanation or text,
+        'simple_explanation': summary[:SUMMARY_MAX_LENGTH],
+        'steps': _numbered(steps),
+        'difficulty': _difficulty(data.get('difficulty'), default_difficulty),
+    }
+
+
+def _load_json(text):
+    candidate = FENCE_RE.sub('', text)
+    start, end = candidate.find('{'), candidate.rfind('}')
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(candidate[start:end + 1])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _parse_prose(text, default_difficulty):
+    match = DIFFICULTY_RE.search(text)
+    # Steps and difficulty get their own fields; don't store them twice
+    explanation = DIFFICULTY_LINE_RE.sub('', STEP_LINE_RE.sub('', text))
+    explanation = BLANK_LINES_RE.sub('\n', explanation).strip()
+    return {
+        'explanation': explanation or text,
+        'simple_explanation': _summarize(text),
+        'steps': _numbered([description.strip() for _, description in STEP_LINE_RE.findall(text)]),
+        'difficulty': match.group(1).lower() if match else default_difficulty,
+    }
+
+
+def _summarize(text):
+    first = SENTENCE_RE.split(text.strip(), maxsplit=1)[0] if text else ''
+    if len(first) > SUMMARY_MAX_LENGTH:
+        return first[:SUMMARY_MAX_LENGTH - 3].rstrip() + '...'
+    return first
+
+
+def _numbered(steps):
+    return [{'step': index, 'description': description} for index, description in enumerate(steps, 1)]
+
+
+def _difficulty(value, default):
+    value = _text(value).lower()
+    return value if value in DIFFICULTIES else default
+
+
+def _text(value):
+    return value.strip() if isinstance(value, str) else ''
+
+
+def _list(value):
+    return value if isinstance(value, list) else []
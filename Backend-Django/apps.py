@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class HomeworkHelperConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'homework_helper'
+
+    def ready(self):
+        from . import signals  # noqa: F401
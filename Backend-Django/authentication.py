@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+from .activity import record_activity
+
+# Token -> (user, token) resolution is cached in a small per-process LRU in
+# front of Redis. Entries are dropped by signals on logout, token rotation and
+# user saves (which covers is_active changes); other processes catch up when
+# their local entry expires after AUTH_TOKEN_LOCAL_TTL seconds.
+TOKEN_KEY = 'auth:token:{key}'
+USER_KEY = 'auth:user:{user_id}'
+STATS_KEY = 'auth:stats'
+
+_local = OrderedDict()
+_lock = threading.Lock()
+_stats = {'local_hits': 0, 'cache_hits': 0, 'misses': 0}
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Drop-in TokenAuthentication that skips the Token/User query on repeat calls"""
+
+    def authenticate_credentials(self, key):
+        credentials = self._resolve(key)
+        record_activity(credentials[0].pk)
+        return credentials
+
+    def _resolve(self, key):
+        credentials = _local_get(key)
+        if credentials is not None:
+            _count('local_hits')
+            return credentials
+
+        credentials = cache.get(TOKEN_KEY.format(key=key))
+        if credentials is not None:
+            _count('cache_hits')
+        else:
+            _count('misses')
+            # Raises AuthenticationFailed for unknown tokens and inactive users
+            credentials = super().authenticate_credentials(key)
+            user = credentials[0]
+            cache.set_many({
+                TOKEN_KEY.format(key=key): credentials,
+                USER_KEY.format(user_id=user.pk): key,
+            }, settings.AUTH_TOKEN_CACHE_TTL)
+
+        _local_set(key, credentials)
+        return credentials
+
+
+def invalidate_token(key):
+    with _lock:
+        _local.pop(key, None)
+    cache.delete(TOKEN_KEY.format(key=key))
+
+
+def invalidate_user(user_id):
+    key = cache.get(USER_KEY.format(user_id=user_id))
+    if key:
+        invalidate_token(key)
+
+
+def invalidate_users(user_ids):
+    keys = cache.get_many([USER_KEY.format(user_id=user_id) for user_id in user_ids])
+    for key in keys.values():
+        invalidate_token(key)
+
+
+def get_stats():
+    """Hit counters across all processes (plus this process's unflushed counts)"""
+    _flush_stats()
+    totals = {name: int(cache.get(f"{STATS_KEY}:{name}") or 0) for name in _stats}
+    lookups = sum(totals.values())
+    totals['hit_ratio'] = round((lookups - totals['misses']) / lookups, 4) if lookups else 0.0
+    return totals
+
+
+def _local_get(key):
+    with _lock:
+        entry = _local.get(key)
+        if entry is None:
+            return None
+        expires_at, credentials = entry
+        if expires_at < time.monotonic():
+            del _local[key]
+            return None
+        _local.move_to_end(key)
+        return credentials
+
+
+def _local_set(key, credentials):
+    with _lock:
+        _local[key] = (time.monotonic() + settings.AUTH_TOKEN_LOCAL_TTL, credentials)
+        _local.move_to_end(key)
+        while len(_local) > settings.AUTH_TOKEN_LOCAL_MAX_ENTRIES:
+            _local.popitem(last=False)
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+        pending = sum(_stats.values())
+    # Counters are pushed to Redis in batches to keep the hot path local
+    if pending >= settings.AUTH_STATS_FLUSH_EVERY:
+        _flush_stats()
+
+
+def _flush_stats():
+    with _lock:
+        counts = dict(_stats)
+        for name in _stats:
+            _stats[name] = 0
+    for name, count in counts.items():
+        if count:
+            cache.add(f"{STATS_KEY}:{name}", 0, timeout=None)
+            cache.incr(f"{STATS_KEY}:{name}", count)
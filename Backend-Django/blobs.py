@@ -0,0 +1,133 @@
+import hashlib
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from . import imaging
+from .models import ImageBlob, Question
+
+# Question images are stored once per distinct content, named after their
+# SHA-256 digest, and shared by every question that uploads the same bytes.
+# Blobs whose reference count drops to zero are removed by collect_garbage().
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """Hashes uploads as they stream in; digests land in request.upload_digests.
+
+    Chunks are passed through untouched, so the memory and temporary file
+    handlers after this one still decide where the upload is kept.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if not hasattr(self.request, 'upload_digests'):
+            self.request.upload_digests = {}
+        self.request.upload_digests[self.field_name] = self.hasher.hexdigest()
+        return None
+
+
+def digest_file(upload):
+    # For files that did not come through HashingUploadHandler
+    hasher = hashlib.sha256()
+    for chunk in upload.chunks():
+        hasher.update(chunk)
+    upload.seek(0)
+    return hasher.hexdigest()
+
+
+def store(upload, digest=None):
+    """Return the blob for an upload, saving the file only if it is new"""
+    digest = digest or digest_file(upload)
+    collected = False
+    while True:
+        blob = ImageBlob.objects.filter(digest=digest).first()
+        if blob is None:
+            name = blob_name(digest, upload.name)
+            # After a collection race the old file may still be about to go,
+            # so save a fresh copy (storage picks a free name) instead of reusing it
+            saved = collected or not default_storage.exists(name)
+            if saved:
+                name = default_storage.save(name, upload)
+            blob, created = ImageBlob.objects.get_or_create(
+                digest=digest,
+                defaults={'file': name, 'size': upload.size}
+            )
+            if saved and not created:
+                # A concurrent upload of the same image got there first
+                default_storage.delete(name)
+            if created:
+                _queue_thumbnails(blob.pk)
+        # Zero rows means garbage collection removed the blob meanwhile
+        if ImageBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1):
+            blob.ref_count += 1
+            return blob
+        collected = True
+
+
+def generate_thumbnails(blob_id):
+    """Render any missing IMAGE_THUMBNAIL_SIZES for a blob. Returns sizes rendered."""
+    blob = ImageBlob.objects.filter(pk=blob_id).first()
+    if blob is None:
+        return 0
+
+    thumbnails = dict(blob.thumbnails)
+    missing = [size for size in settings.IMAGE_THUMBNAIL_SIZES if size not in thumbnails]
+    if not missing:
+        return 0
+    with blob.file.open('rb') as original:
+        for size in missing:
+            data = imaging.make_thumbnail(original, settings.IMAGE_THUMBNAIL_SIZES[size])
+            thumbnails[size] = default_storage.save(thumbnail_name(blob.digest, size), ContentFile(data))
+    ImageBlob.objects.filter(pk=blob_id).update(thumbnails=thumbnails)
+    # Question bodies now list the thumbnails; move their ETags on
+    Question.objects.filter(image_blob_id=blob_id).update(updated_at=timezone.now())
+    return len(missing)
+
+
+def release(blob_id):
+    ImageBlob.objects.filter(pk=blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+
+
+def collect_garbage(batch_size=500):
+    """Delete unreferenced blobs and their files. Returns blobs deleted."""
+    # Blobs start at zero references; give new ones time to be claimed
+    cutoff = timezone.now() - timedelta(seconds=settings.IMAGE_BLOB_GRACE_PERIOD)
+    with transaction.atomic():
+        orphans = list(
+            ImageBlob.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(ref_count=0, created_at__lt=cutoff, questions__isnull=True)
+            .values_list('pk', 'file', 'thumbnails')[:batch_size]
+        )
+        ImageBlob.objects.filter(pk__in=[orphan[0] for orphan in orphans], ref_count=0).delete()
+    for _, name, thumbnails in orphans:
+        for file_name in [name, *thumbnails.values()]:
+            default_storage.delete(file_name)
+    return len(orphans)
+
+
+def blob_name(digest, original_name):
+    extension = os.path.splitext(original_name or '')[1].lower() or '.jpg'
+    return f"question_images/{digest[:2]}/{digest}{extension}"
+
+
+def thumbnail_name(digest, size):
+    return f"question_thumbnails/{digest[:2]}/{digest}_{size}.jpg"
+
+
+def _queue_thumbnails(blob_id):
+    from .tasks import generate_thumbnails
+    transaction.on_commit(lambda: generate_thumbnails.apply_async(
+        (blob_id,), queue=settings.IMAGE_QUESTION_QUEUE
+    ))
@@ -15,6 +15,34 @@ app.conf.beat_schedule = {
         'task': 'homework_helper.tasks.process_expired_subscriptions',
         'schedule': crontab(hour=0, minute=0),  # Run daily at midnight
     },
+    'apply-mpesa-callbacks': {
+        'task': 'homework_helper.tasks.apply_mpesa_callbacks',
+        'schedule': 5.0,  # Every 5 seconds
+    },
+    'dispatch-notifications': {
+        'task': 'homework_helper.tasks.dispatch_notifications',
+        'schedule': 10.0,  # Every 10 seconds
+    },
+    'compact-credit-ledger': {
+        'task': 'homework_helper.tasks.compact_credit_ledger',
+        'schedule': 60.0,  # Every minute
+    },
+    'flush-user-activity': {
+        'task': 'homework_helper.tasks.flush_user_activity',
+        'schedule': 300.0,  # Every 5 minutes
+    },
+    'refresh-usage-rollups': {
+        'task': 'homework_helper.tasks.refresh_usage_rollups',
+        'schedule': 60.0,  # Every minute
+    },
+    'collect-image-blobs': {
+        'task': 'homework_helper.tasks.collect_image_blobs',
+        'schedule': crontab(minute=30),  # Every hour
+    },
+    'send-subscription-reminders': {
+        'task': 'homework_helper.tasks.send_subscription_reminders',
+        'schedule': crontab(hour=9, minute=0),  # Run daily at 9 AM
+    },
     'send-daily-usage-report': {
         'task': 'homework_helper.tasks.send_daily_usage_report',
         'schedule': crontab(hour=8, minute=0),  # Run daily at 8 AM
@@ -23,12 +51,43 @@ app.conf.beat_schedule = {
 
 # ================================
 # tests.py
-from django.test import TestCase
+import io
+import json
+import smtplib
+import tempfile
+import threading
+import time
+import unittest
+import requests
+from celery.utils.time import get_exponential_backoff_interval
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from datetime import timedelta
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.test import APIClient
 from rest_framework import status
-from .models import Child, Question, Payment, Subscription
+from rest_framework.authtoken.models import Token
+from django.core.files.uploadedfile import SimpleUploadedFile
+from .models import Child, Question, Payment, Subscription, Notification, ImageBlob, DailyUsageRollup
+from . import activity, answers, blobs, clients, credits, mailer, notifications, prompts, rollups, tasks
+from PIL import Image, ImageDraw
+from .answer_cache import AnswerCache, question_fingerprint
+from .imaging import prepare_image
+from .clients import get_redis
+from .providers import ProviderUnavailable, RouterProvider, StubProvider
+from .services import PaymentService
+from django.core import mail
+from django.core.cache import cache
+from .tasks import (
+    compact_credit_ledger, dispatch_notifications, dispatch_stk_push, flush_user_activity,
+    process_expired_subscriptions, process_question_async, send_daily_usage_report, send_mail_batch,
+    send_subscription_reminders
+)
 
 User = get_user_model()
 
@@ -69,8 +128,90 @@ class UserAuthTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('token', response.data)
 
+    def test_logout_revokes_cached_token(self):
+        response = self.client.post('/api/auth/register/', self.user_data)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {response.data['token']}")
+
+        # Second request is served from the token cache
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, status.HTTP_200_OK)
+
+        self.assertEqual(self.client.post('/api/auth/logout/').status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+class ActivityTestCase(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        get_redis().delete(
+            activity.LAST_SEEN_KEY, activity.FLUSHING_KEY,
+            activity.DAILY_USERS_KEY.format(day=self.today.isoformat())
+        )
+        activity._recent.clear()
+        self.client = APIClient()
+        self.users = [
+            User.objects.create_user(
+                username=f'parent{n}', email=f'parent{n}@example.com', password='testpass123', phone='+254712345678'
+            )
+            for n in range(3)
+        ]
+
+    def assertNoUserWrites(self, queries):
+        writes = [query['sql'] for query in queries if query['sql'].startswith('UPDATE') and '_user"' in query['sql']]
+        self.assertEqual(writes, [])
+
+    def test_login_and_token_auth_record_activity(self):
+        user = self.users[0]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/auth/login/', {'email': user.email, 'password': 'testpass123'})
+        self.assertNoUserWrites(queries)
+        self.assertIn(str(user.pk), get_redis().hgetall(activity.LAST_SEEN_KEY))
+
+        other = self.users[1]
+        token = Token.objects.create(user=other)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/api/auth/profile/').status_code, status.HTTP_200_OK)
+        self.assertNoUserWrites(queries)
+        self.assertIn(str(other.pk), get_redis().hgetall(activity.LAST_SEEN_KEY))
+
+        user.refresh_from_db()
+        self.assertIsNone(user.last_login)
+        self.assertEqual(activity.count_active_users(self.today), 2)
+
+    def test_repeat_requests_are_recorded_once_per_interval(self):
+        with mock.patch.object(activity, 'get_redis', wraps=get_redis) as redis_client:
+            for _ in range(5):
+                activity.record_activity(self.users[0].pk)
+        self.assertEqual(redis_client.call_count, 1)
+
+    def test_flush_writes_last_login_in_bulk(self):
+        for user in self.users:
+            activity.record_activity(user.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(flush_user_activity(), 3)
+        for user in self.users:
+            user.refresh_from_db()
+            self.assertIsNotNone(user.last_login)
+        # Nothing new to write
+        self.assertEqual(flush_user_activity(), 0)
+
+    def test_flush_resumes_a_crashed_batch(self):
+        redis_client = get_redis()
+        redis_client.hset(activity.FLUSHING_KEY, self.users[0].pk, 1700000000)
+        activity.record_activity(self.users[1].pk)
+
+        self.assertEqual(flush_user_activity(), 1)
+        self.users[0].refresh_from_db()
+        self.assertEqual(self.users[0].last_login.timestamp(), 1700000000)
+        # Activity recorded meanwhile waits for the next flush
+        self.assertEqual(flush_user_activity(), 1)
+        self.users[1].refresh_from_db()
+        self.assertIsNotNone(self.users[1].last_login)
+
 class QuestionTestCase(TestCase):
     def setUp(self):
+        # Answers cached by an earlier test would skip the AI call
+        AnswerCache().cache.clear()
         self.client = APIClient()
         self.user = User.objects.create_user(
             username='testuser',
@@ -89,11 +230,69 @@ class QuestionTestCase(TestCase):
         }
         
         response = self.client.post('/api/questions/', question_data)
-        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn('question_id', response.data)
+        self.assertEqual(response.data['status'], 'queued')
         
         # Check that user's credits were deducted
-        self.user.refresh_from_db()
-        self.assertEqual(self.user.credits, 2)
+        self.assertEqual(credits.get_balance(self.user.pk), 2)
+        self.assertEqual(self.user.credit_transactions.get().delta, -1)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_identical_images_are_stored_once(self):
+        page = io.BytesIO()
+        Image.new('RGB', (200, 100), 'white').save(page, format='PNG')
+
+        for _ in range(2):
+            response = self.client.post('/api/questions/', {
+                'type': 'image',
+                'content': 'Help with question 3',
+                'subject': 'Mathematics',
+                'grade_level': 'Grade 4',
+                'image': SimpleUploadedFile('page.png', page.getvalue(), content_type='image/png')
+            }, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        blob = ImageBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(
+            set(Question.objects.values_list('image', flat=True)), {blob.file.name}
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Question.objects.first().delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp(), MEDIA_OFFLOAD='x-accel')
+    def test_images_are_served_by_the_web_server(self):
+        page = io.BytesIO()
+        Image.new('RGB', (1200, 800), 'white').save(page, format='PNG')
+        self.client.post('/api/questions/', {
+            'type': 'image',
+            'content': 'Help with question 3',
+            'subject': 'Mathematics',
+            'grade_level': 'Grade 4',
+            'image': SimpleUploadedFile('page.png', page.getvalue(), content_type='image/png')
+        }, format='multipart')
+        question = Question.objects.get()
+        self.assertEqual(blobs.generate_thumbnails(question.image_blob_id), 2)
+
+        data = self.client.get(f'/api/questions/{question.pk}/').data
+        self.assertEqual(set(data['thumbnails']), {'small', 'medium'})
+
+        response = self.client.get(data['thumbnails']['small'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['X-Accel-Redirect'].startswith('/protected-media/question_thumbnails/'))
+        self.assertIn('immutable', response['Cache-Control'])
+
+        # Other parents can't fetch it
+        other = User.objects.create_user(
+            username='other', email='other@example.com', password='testpass123', phone='+254712345679'
+        )
+        self.client.force_authenticate(user=other)
+        response = self.client.get(data['image'])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_free_user_credit_limit(self):
         # Use up all credits
@@ -110,6 +309,1006 @@ class QuestionTestCase(TestCase):
         response = self.client.post('/api/questions/', question_data)
         self.assertEqual(response.status_code, status.HTTP_402_PAYMENT_REQUIRED)
 
+    def test_expired_subscription_is_enforced(self):
+        # The nightly sweep hasn't run yet, but the plan has already ended
+        self.user.subscription_type = 'monthly'
+        self.user.subscription_end_date = timezone.now() - timedelta(minutes=1)
+        self.user.credits = 0
+        self.user.save()
+
+        question_data = {
+            'type': 'text',
+            'content': 'What is 5 + 5?',
+            'subject': 'Mathematics',
+            'grade_level': 'Grade 1'
+        }
+
+        response = self.client.post('/api/questions/', question_data)
+        self.assertEqual(response.status_code, status.HTTP_402_PAYMENT_REQUIRED)
+
+    def test_question_list_is_compact(self):
+        child = Child.objects.create(parent=self.user, name='Jane Doe', grade='Grade 3')
+        for n in range(3):
+            Question.objects.create(
+                user=self.user, child=child, type='text', content=f'Question {n}',
+                subject='Mathematics', grade_level='Grade 3', ai_response='A long answer'
+            )
+
+        response = self.client.get('/api/questions/')
+        item = response.data['results'][0]
+        self.assertEqual(item['child_name'], 'Jane Doe')
+        self.assertNotIn('ai_response', item)
+
+        response = self.client.get('/api/questions/?expand=ai_response&fields=id,ai_response')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'ai_response'})
+
+        # One query for the page, however many rows have a child
+        with self.assertNumQueries(1):
+            self.client.get('/api/questions/')
+
+    def test_question_list_filters_by_difficulty(self):
+        for n, difficulty in enumerate(['easy', 'hard', 'hard']):
+            Question.objects.create(
+                user=self.user, type='text', content=f'Question {n}',
+                subject='Mathematics', grade_level='Grade 3', difficulty=difficulty
+            )
+
+        response = self.client.get('/api/questions/?difficulty=hard')
+        self.assertEqual(len(response.data['results']), 2)
+        for item in response.data['results']:
+            self.assertEqual(item['difficulty'], 'hard')
+
+    def test_question_status(self):
+        question = Question.objects.create(
+            user=self.user,
+            type='text',
+            content='What is 4 + 4?',
+            subject='Mathematics',
+            grade_level='Grade 1'
+        )
+
+        response = self.client.get(f'/api/questions/{question.question_id}/status/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertIn('Retry-After', response)
+
+        question.status = 'done'
+        question.is_processed = True
+        question.save()
+
+        response = self.client.get(f'/api/questions/{question.question_id}/status/')
+        self.assertEqual(response.data['status'], 'done')
+        self.assertNotIn('Retry-After', response)
+
+    @override_settings(AI_PROVIDER='stub')
+    def test_stream_question(self):
+        question = Question.objects.create(
+            user=self.user,
+            type='text',
+            content='Why is the sky blue?',
+            subject='Science',
+            grade_level='Grade 3'
+        )
+
+        response = self.client.get(
+            f'/api/questions/{question.question_id}/stream/',
+            HTTP_ACCEPT='text/event-stream'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = b''.join(response.streaming_content).decode()
+        self.assertIn('event: token', body)
+        self.assertIn('event: done', body)
+
+        question.refresh_from_db()
+        self.assertEqual(question.status, 'done')
+        self.assertEqual(question.ai_response, "Let's work through this together.")
+        self.assertEqual(len(question.step_by_step), 3)
+        self.assertEqual(question.difficulty, 'easy')
+        # Streamed answers announce themselves through the outbox too
+        self.assertEqual(Notification.objects.get().dedupe_key, f'question-answered:{question.pk}')
+
+    @override_settings(AI_PROVIDER='stub')
+    def test_answer_notification_goes_through_outbox(self):
+        question = Question.objects.create(
+            user=self.user,
+            type='text',
+            content='Why is the sky blue?',
+            subject='Science',
+            grade_level='Grade 3'
+        )
+
+        process_question_async(question.id)
+        process_question_async(question.id)  # a redelivered task notifies once
+        self.assertEqual(Notification.objects.filter(status='pending').count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+        question.refresh_from_db()
+        self.assertEqual(question.explanation, "Let's work through this together.")
+        self.assertEqual(question.step_by_step[0], {'step': 1, 'description': 'Read the question carefully with your child.'})
+
+        self.assertEqual(dispatch_notifications(), {'email': 1})
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+        self.assertEqual(Notification.objects.get().status, 'sent')
+
+class NotificationDispatchTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser', email='test@example.com', password='testpass123', phone='+254712345678'
+        )
+        for n in range(2):
+            notifications.add(self.user, 'email', self.user.email, f'Answer {n}', 'Ready', f'test:{n}')
+
+    @override_settings(NOTIFICATION_MAX_ATTEMPTS=2)
+    def test_failures_are_tracked_per_notification(self):
+        statuses = []
+
+        def send(connection, email):
+            # Rows are claimed before any mail goes out
+            statuses.append(set(Notification.objects.values_list('status', flat=True)))
+            if email.subject == 'Answer 1':
+                raise smtplib.SMTPDataError(554, 'Rejected')
+            return 1
+
+        with mock.patch.object(mailer, '_send', side_effect=send):
+            self.assertEqual(notifications.dispatch('email'), 2)
+            self.assertEqual(statuses, [{'sending'}, {'sending'}])
+            self.assertEqual(
+                dict(Notification.objects.values_list('subject', 'status')),
+                {'Answer 0': 'sent', 'Answer 1': 'pending'}
+            )
+
+            # Only the failed one is sent again, then given up on
+            self.assertEqual(notifications.dispatch('email'), 1)
+            self.assertEqual(Notification.objects.get(subject='Answer 1').status, 'failed')
+
+    def test_abandoned_claims_are_retried(self):
+        Notification.objects.update(status='sending', claimed_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(notifications.dispatch('email'), 2)
+        self.assertEqual(len(mail.outbox), 2)
+
+class CreditLedgerTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123',
+            phone='+254712345678'
+        )
+        self.user.credits = 20
+        self.user.save(update_fields=['credits'])
+
+    def test_parallel_spends_never_overdraw(self):
+        results = []
+
+        def submit():
+            try:
+                results.append(credits.spend(self.user.pk))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=submit) for _ in range(60)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(results), 20)
+        self.assertEqual(credits.get_balance(self.user.pk), 0)
+
+        # The ledger and the compacted balance agree with the live counter
+        credits.compact_ledger()
+        credits.forget_balance(self.user.pk)
+        self.assertEqual(credits.get_balance(self.user.pk), 0)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.credits, 0)
+
+    def read_balance(self):
+        try:
+            self.seen = credits.get_balance(self.user.pk)
+        finally:
+            connection.close()
+
+    def test_admin_edit_survives_a_read_before_commit(self):
+        with transaction.atomic():
+            self.user.credits = 50
+            self.user.save(update_fields=['credits'])
+            # Another request reads the old committed row and re-seeds the counter
+            reader = threading.Thread(target=self.read_balance)
+            reader.start()
+            reader.join()
+        self.assertEqual(self.seen, 20)
+        self.assertEqual(credits.get_balance(self.user.pk), 50)
+
+class HttpClientTestCase(SimpleTestCase):
+    def tearDown(self):
+        clients.reset_clients()
+
+    def test_sessions_are_shared_within_a_process(self):
+        seen = []
+        threads = [threading.Thread(target=lambda: seen.append(clients.get_http_session('openai'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len({id(session) for session in seen}), 1)
+        self.assertIsNot(clients.get_http_session('mpesa'), seen[0])
+
+    def test_forked_process_gets_its_own_session(self):
+        parent = clients.get_http_session('openai')
+        with mock.patch.object(parent, 'close') as close, mock.patch.object(clients.os, 'getpid', return_value=-1):
+            child = clients.get_http_session('openai')
+            self.assertIs(clients.get_http_session('openai'), child)
+        self.assertIsNot(child, parent)
+        # The parent's sockets are left alone
+        close.assert_not_called()
+
+    def test_default_timeout_per_service(self):
+        session = clients.get_http_session('mpesa')
+        with mock.patch('requests.Session.request') as request:
+            session.get('https://example.com/')
+            session.get('https://example.com/', timeout=1)
+        self.assertEqual(request.call_args_list[0].kwargs['timeout'], (3.05, 20))
+        self.assertEqual(request.call_args_list[1].kwargs['timeout'], 1)
+
+def daraja_response(status_code=200, **body):
+    response = mock.Mock(status_code=status_code)
+    response.json.return_value = body
+    return response
+
+class MpesaTokenTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.delete_many([PaymentService.TOKEN_CACHE_KEY, PaymentService.TOKEN_LOCK_KEY])
+        self.addCleanup(cache.delete, PaymentService.TOKEN_CACHE_KEY)
+
+    def test_concurrent_refreshes_fetch_once(self):
+        def slow_token(*args, **kwargs):
+            time.sleep(0.2)
+            return daraja_response(access_token='token-1', expires_in='3599')
+
+        tokens = []
+        with mock.patch.object(clients.get_http_session('mpesa'), 'get', side_effect=slow_token) as get:
+            threads = [
+                threading.Thread(target=lambda: tokens.append(PaymentService()._get_mpesa_access_token()))
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(tokens, ['token-1'] * 8)
+
+    @override_settings(MPESA_TOKEN_EXPIRY_MARGIN=120)
+    def test_token_is_refreshed_before_it_expires(self):
+        responses = [daraja_response(access_token='token-1', expires_in='121'), daraja_response(access_token='token-2')]
+        with mock.patch.object(clients.get_http_session('mpesa'), 'get', side_effect=responses) as get:
+            service = PaymentService()
+            self.assertEqual(service._get_mpesa_access_token(), 'token-1')
+            self.assertEqual(service._get_mpesa_access_token(), 'token-1')
+            # Cached for expires_in minus the margin: one second here
+            time.sleep(1.1)
+            self.assertEqual(service._get_mpesa_access_token(), 'token-2')
+        self.assertEqual(get.call_count, 2)
+
+    def test_revoked_token_is_replaced(self):
+        cache.set(PaymentService.TOKEN_CACHE_KEY, 'revoked')
+        session = clients.get_http_session('mpesa')
+        with mock.patch.object(session, 'get', return_value=daraja_response(access_token='token-2')), \
+                mock.patch.object(session, 'post', side_effect=[daraja_response(401), daraja_response()]) as post:
+            response = PaymentService()._post_with_token('https://example.com/stk', {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(post.call_args.kwargs['headers']['Authorization'], 'Bearer token-2')
+
+class StkDispatchTestCase(TestCase):
+    def setUp(self):
+        cache.set(PaymentService.TOKEN_CACHE_KEY, 'token')
+        self.addCleanup(cache.delete, PaymentService.TOKEN_CACHE_KEY)
+        user = User.objects.create_user(
+            username='testuser', email='test@example.com', password='testpass123', phone='+254712345678'
+        )
+        self.payment = Payment.objects.create(
+            user=user, transaction_id='HH-1', amount=100, payment_method='mpesa', type='credits'
+        )
+        self.countdowns = []
+
+    def backoff(self, **kwargs):
+        self.assertTrue(kwargs['full_jitter'])
+        countdown = get_exponential_backoff_interval(**kwargs)
+        self.countdowns.append((kwargs['retries'], countdown))
+        return countdown
+
+    def dispatch(self, responses):
+        # apply() runs the task and its retries inline, ignoring the countdowns
+        with mock.patch.object(tasks, 'get_exponential_backoff_interval', side_effect=self.backoff), \
+                mock.patch.object(clients.get_http_session('mpesa'), 'post', side_effect=responses) as post:
+            dispatch_stk_push.apply(args=(self.payment.id,))
+        self.payment.refresh_from_db()
+        return post.call_count
+
+    @override_settings(MPESA_STK_RETRY_BACKOFF=2, MPESA_STK_RETRY_BACKOFF_MAX=60)
+    def test_transient_failures_are_retried_with_backoff(self):
+        calls = self.dispatch([
+            requests.Timeout(),
+            requests.ConnectionError(),
+            daraja_response(503),
+            daraja_response(CheckoutRequestID='ws_CO_1'),
+        ])
+        self.assertEqual(calls, 4)
+        self.assertEqual((self.payment.status, self.payment.checkout_request_id), ('pending', 'ws_CO_1'))
+        self.assertEqual([retries for retries, _ in self.countdowns], [0, 1, 2])
+        for retries, countdown in self.countdowns:
+            self.assertTrue(0 <= countdown <= min(2 * 2 ** retries, 60))
+
+    def test_gives_up_after_max_retries(self):
+        calls = self.dispatch(requests.Timeout())
+        self.assertEqual(calls, dispatch_stk_push.max_retries + 1)
+        self.assertEqual(len(self.countdowns), dispatch_stk_push.max_retries)
+        self.assertEqual(self.payment.status, 'failed')
+
+    def test_redelivered_task_does_not_push_again(self):
+        self.assertEqual(self.dispatch([daraja_response(CheckoutRequestID='ws_CO_1')]), 1)
+        self.assertEqual(self.dispatch([daraja_response(CheckoutRequestID='ws_CO_2')]), 0)
+        self.assertEqual(self.payment.checkout_request_id, 'ws_CO_1')
+
+    def test_rejected_push_is_not_retried(self):
+        calls = self.dispatch([daraja_response(400)])
+        self.assertEqual(calls, 1)
+        self.assertEqual(self.countdowns, [])
+        self.assertEqual(self.payment.status, 'failed')
+
+def stk_callback(checkout_request_id, result_code=0, receipt_number=None):
+    callback = {'CheckoutRequestID': checkout_request_id, 'ResultCode': result_code}
+    if receipt_number:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 100},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt_number},
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+class MpesaCallbackTestCase(TestCase):
+    def setUp(self):
+        redis_client = get_redis()
+        stale = list(redis_client.scan_iter('mpesa:callbacks:*'))
+        if stale:
+            redis_client.delete(*stale)
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser', email='test@example.com', password='testpass123', phone='+254712345678'
+        )
+        self.payments = [
+            Payment.objects.create(
+                user=self.user, transaction_id=f'HH-{n}', amount=100, payment_method='mpesa',
+                type='credits', checkout_request_id=f'ws_CO_{n}'
+            )
+            for n in range(3)
+        ]
+
+    def queued(self):
+        return [json.loads(raw) for raw in get_redis().lrange(PaymentService.CALLBACK_QUEUE_KEY, 0, -1)]
+
+    def test_duplicate_callbacks_are_queued_once(self):
+        for _ in range(2):
+            response = self.client.post('/api/mpesa/callback/', stk_callback('ws_CO_0', 0, 'RCP0'), format='json')
+            self.assertEqual(response.data, {'ResultCode': 0, 'ResultDesc': 'Accepted'})
+        self.assertEqual(self.queued(), [
+            {'checkout_request_id': 'ws_CO_0', 'result_code': 0, 'receipt_number': 'RCP0', 'attempts': 0}
+        ])
+
+    def test_malformed_callbacks_get_a_daraja_reply(self):
+        for body in ({'Body': 'oops'}, {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_0', 'ResultCode': 'x'}}}, []):
+            response = self.client.post('/api/mpesa/callback/', body, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data['ResultCode'], 1)
+
+        response = self.client.post('/api/mpesa/callback/', '{not json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['ResultCode'], 1)
+
+        # Odd metadata entries are skipped rather than failing the callback
+        body = stk_callback('ws_CO_0')
+        body['Body']['stkCallback']['CallbackMetadata'] = {'Item': ['oops', {'Name': 'MpesaReceiptNumber', 'Value': 'RCP0'}]}
+        response = self.client.post('/api/mpesa/callback/', body, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.queued()[0]['receipt_number'], 'RCP0')
+
+    def test_batch_is_applied(self):
+        service = PaymentService()
+        service.enqueue_callback(stk_callback('ws_CO_0', 0, 'RCP0'))
+        service.enqueue_callback(stk_callback('ws_CO_1', 1032))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(service.apply_callbacks(), 2)
+
+        self.assertEqual(
+            dict(Payment.objects.values_list('checkout_request_id', 'status')),
+            {'ws_CO_0': 'completed', 'ws_CO_1': 'failed', 'ws_CO_2': 'pending'}
+        )
+        self.assertEqual(self.user.credit_transactions.get().delta, 10)
+        self.assertEqual(self.queued(), [])
+
+    @override_settings(MPESA_CALLBACK_MAX_ATTEMPTS=2)
+    def test_unknown_checkouts_are_retried_then_dropped(self):
+        service = PaymentService()
+        service.enqueue_callback(stk_callback('ws_CO_unknown', 0, 'RCP9'))
+        self.assertEqual(service.apply_callbacks(), 0)
+        self.assertEqual(self.queued()[0]['attempts'], 1)
+
+        self.assertEqual(service.apply_callbacks(), 0)
+        self.assertEqual(self.queued(), [])
+        self.assertEqual(get_redis().llen(PaymentService.CALLBACK_FAILED_KEY), 0)
+
+    @override_settings(MPESA_CALLBACK_MAX_ATTEMPTS=2)
+    def test_failing_callback_does_not_block_the_queue(self):
+        service = PaymentService()
+        # Two payments reported with the same receipt: the second breaks the unique constraint
+        service.enqueue_callback(stk_callback('ws_CO_0', 0, 'RCP0'))
+        service.enqueue_callback(stk_callback('ws_CO_1', 0, 'RCP0'))
+        service.enqueue_callback(stk_callback('ws_CO_2', 0, 'RCP2'))
+        self.assertEqual(service.apply_callbacks(), 2)
+        self.assertEqual(
+            dict(Payment.objects.values_list('checkout_request_id', 'status')),
+            {'ws_CO_0': 'completed', 'ws_CO_1': 'pending', 'ws_CO_2': 'completed'}
+        )
+        self.assertEqual([item['checkout_request_id'] for item in self.queued()], ['ws_CO_1'])
+
+        self.assertEqual(service.apply_callbacks(), 0)
+        self.assertEqual(self.queued(), [])
+        failed = get_redis().lrange(PaymentService.CALLBACK_FAILED_KEY, 0, -1)
+        self.assertEqual([json.loads(raw)['checkout_request_id'] for raw in failed], ['ws_CO_1'])
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'Query plans are checked on PostgreSQL')
+class QueryPlanTestCase(TestCase):
+    """Seeds realistic volumes and checks each endpoint's queries use an index"""
+    USERS = 200
+    QUESTIONS_PER_USER = 50
+    PAYMENTS_PER_USER = 20
+    SUBSCRIPTIONS_PER_USER = 6
+    TABLES = ['homework_helper_question', 'homework_helper_payment', 'homework_helper_subscription']
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        users = User.objects.bulk_create([
+            User(username=f'user{i}', email=f'user{i}@example.com', phone='+254712345678')
+            for i in range(cls.USERS)
+        ])
+        Question.objects.bulk_create([
+            Question(
+                user=user, type='text', content=f'Question {n}', subject=['Mathematics', 'Science', 'English'][n % 3],
+                grade_level=f'Grade {n % 8 + 1}', is_processed=n % 10 != 0, status='done' if n % 10 else 'queued'
+            )
+            for user in users for n in range(cls.QUESTIONS_PER_USER)
+        ], batch_size=2000)
+        Payment.objects.bulk_create([
+            Payment(
+                user=user, transaction_id=f'HH{user.pk}-{n}', amount=100, payment_method='mpesa',
+                status='completed' if n % 20 else 'pending', type='credits'
+            )
+            for user in users for n in range(cls.PAYMENTS_PER_USER)
+        ], batch_size=2000)
+        Subscription.objects.bulk_create([
+            Subscription(
+                user=user, plan_type='monthly', amount=500,
+                end_date=now + timedelta(days=30 * n - 150),
+                status='active' if n == cls.SUBSCRIPTIONS_PER_USER - 1 else 'expired'
+            )
+            for user in users for n in range(cls.SUBSCRIPTIONS_PER_USER)
+        ], batch_size=2000)
+        with connection.cursor() as cursor:
+            for table in cls.TABLES:
+                cursor.execute(f'ANALYZE {table}')
+        cls.user = users[0]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def assertPlanUsesIndexes(self, plan, sql):
+        for table in self.TABLES:
+            self.assertNotIn(f'Seq Scan on {table}', plan, f'{sql}\n{plan}')
+
+    def assertEndpointUsesIndexes(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for query in queries.captured_queries:
+            if any(table in query['sql'] for table in self.TABLES):
+                with connection.cursor() as cursor:
+                    cursor.execute(f"EXPLAIN {query['sql']}")
+                    plan = '\n'.join(row[0] for row in cursor.fetchall())
+                self.assertPlanUsesIndexes(plan, query['sql'])
+
+    def test_question_list(self):
+        self.assertEndpointUsesIndexes('/api/questions/')
+
+    def test_payment_list(self):
+        self.assertEndpointUsesIndexes('/api/payments/')
+
+    def test_subscription_list(self):
+        self.assertEndpointUsesIndexes('/api/subscriptions/')
+
+    def test_question_detail(self):
+        question = self.user.questions.first()
+        self.assertEndpointUsesIndexes(f'/api/questions/{question.pk}/')
+
+    def test_expiry_sweep(self):
+        queryset = Subscription.objects.filter(status='active', end_date__lt=timezone.now()).values_list('id', 'user_id')
+        self.assertPlanUsesIndexes(queryset.explain(), str(queryset.query))
+
+    def test_unprocessed_questions(self):
+        queryset = Question.objects.filter(is_processed=False).order_by('created_at')[:100]
+        self.assertPlanUsesIndexes(queryset.explain(), str(queryset.query))
+
+class HistoryPaginationTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123',
+            phone='+254712345678'
+        )
+        self.client.force_authenticate(user=self.user)
+        for n in range(45):
+            Question.objects.create(
+                user=self.user,
+                type='text',
+                content=f'Question {n}',
+                subject='Mathematics',
+                grade_level='Grade 1'
+            )
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_cursor_walks_every_question_once(self):
+        expected = list(Question.objects.filter(user=self.user).order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/api/questions/'), expected)
+        self.assertEqual(self.walk('/api/questions/?order=asc'), expected[::-1])
+
+    def test_previous_link_returns_earlier_page(self):
+        first = self.client.get('/api/questions/')
+        second = self.client.get(first.data['next'])
+        previous = self.client.get(second.data['previous'])
+        self.assertEqual(
+            [item['id'] for item in previous.data['results']],
+            [item['id'] for item in first.data['results']]
+        )
+        self.assertIsNone(previous.data['previous'])
+
+    def test_page_number_mode(self):
+        response = self.client.get('/api/questions/?page=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 45)
+        self.assertEqual(len(response.data['results']), 5)
+
+class PromptTestCase(SimpleTestCase):
+    def test_budget_follows_difficulty(self):
+        easy = prompts.build_prompt('What is 2 + 2?', 'Mathematics', 'Grade 1')
+        self.assertEqual((easy.difficulty, easy.tier), ('easy', 'fast'))
+
+        hard = prompts.build_prompt(
+            'Solve for x and show that both roots satisfy ' + 'the equation 3x^2 - 5x + 2 = 0. ' * 40,
+            'Mathematics', 'Grade 11'
+        )
+        self.assertEqual((hard.difficulty, hard.tier), ('hard', 'strong'))
+        self.assertGreater(hard.max_tokens, easy.max_tokens)
+
+    @override_settings(PROMPT_MAX_QUESTION_TOKENS=50)
+    def test_long_questions_are_truncated(self):
+        prompt = prompts.build_prompt('word ' * 1000 + 'What is the main idea?', 'English', 'Grade 6')
+        self.assertIn('[...]', prompt.text)
+        self.assertTrue(prompt.text.endswith('What is the main idea?'))
+        self.assertLess(prompt.prompt_tokens, 200)
+
+class AnswerParsingTestCase(SimpleTestCase):
+    def test_json_answer_is_split_into_fields(self):
+        parsed = answers.parse_answer(
+            'Sure! ```json\n{"summary": "Add the tens, then the ones.", "explanation": "Split each number.", '
+            '"steps": ["Add 20 and 30", {"description": "Add 4 and 5"}], "difficulty": "Hard", "tip": "Use blocks."}\n```'
+        )
+        self.assertEqual(parsed['simple_explanation'], 'Add the tens, then the ones.')
+        self.assertEqual(parsed['explanation'], 'Split each number.\n\nTip for parents: Use blocks.')
+        self.assertEqual(parsed['steps'], [
+            {'step': 1, 'description': 'Add 20 and 30'},
+            {'step': 2, 'description': 'Add 4 and 5'},
+        ])
+        self.assertEqual(parsed['difficulty'], 'hard')
+
+    def test_malformed_answer_falls_back_to_prose(self):
+        parsed = answers.parse_answer(
+            'Count on from the bigger number. {"steps": [oops\n1. Start at 7\n2) Count 3 more\nDifficulty: easy',
+            default_difficulty='medium'
+        )
+        self.assertEqual(parsed['simple_explanation'], 'Count on from the bigger number.')
+        self.assertEqual([step['description'] for step in parsed['steps']], ['Start at 7', 'Count 3 more'])
+        self.assertEqual(parsed['difficulty'], 'easy')
+
+    def test_unknown_difficulty_uses_default(self):
+        parsed = answers.parse_answer('{"explanation": "Just add.", "difficulty": "tricky"}', default_difficulty='medium')
+        self.assertEqual(parsed['difficulty'], 'medium')
+        self.assertEqual(parsed['steps'], [])
+
+class AnswerCacheTestCase(TestCase):
+    def test_fingerprint_folds_formatting(self):
+        self.assertEqual(
+            question_fingerprint('What is 1,000 × 2.50?', 'Mathematics', 'Grade 4'),
+            question_fingerprint('  what is 1000*2.5 ', 'mathematics', 'grade 4')
+        )
+
+    def test_fingerprint_keeps_operators(self):
+        self.assertNotEqual(
+            question_fingerprint('What is 6/2?', 'Mathematics', 'Grade 4'),
+            question_fingerprint('What is 62?', 'Mathematics', 'Grade 4')
+        )
+
+    def test_fingerprint_separates_grades(self):
+        self.assertNotEqual(
+            question_fingerprint('What is 2 + 2?', 'Mathematics', 'Grade 1'),
+            question_fingerprint('What is 2 + 2?', 'Mathematics', 'Grade 2')
+        )
+
+    def test_fingerprint_keeps_meaningful_punctuation(self):
+        for first, second in [
+            ('What is 5!?', 'What is 5?'),
+            ('Simplify 2:3', 'Simplify 2 3'),
+            ('Expand x·y', 'Expand x y'),
+            ('Plot (1,2)', 'Plot 1 2'),
+            ('What is .5 of 10?', 'What is 5 of 10?'),
+        ]:
+            self.assertNotEqual(
+                question_fingerprint(first, 'Mathematics', 'Grade 6'),
+                question_fingerprint(second, 'Mathematics', 'Grade 6'),
+                f'{first!r} and {second!r}'
+            )
+        # Clause punctuation still folds away
+        self.assertEqual(
+            question_fingerprint('Solve: x + 1 = 2.', 'Mathematics', 'Grade 6'),
+            question_fingerprint('solve x+1=2', 'Mathematics', 'Grade 6')
+        )
+
+class AnswerCacheUsageTestCase(TestCase):
+    CACHED = {
+        'explanation': 'Four.',
+        'simple_explanation': '2 + 2 = 4',
+        'steps': [{'step': 1, 'description': 'Count on 2 from 2.'}],
+        'difficulty': 'easy',
+    }
+
+    def setUp(self):
+        self.answer_cache = AnswerCache()
+        self.answer_cache.cache.clear()
+        self.answer_cache.set('What is 2 + 2?', 'Mathematics', 'Grade 1', self.CACHED)
+        self.user = User.objects.create_user(
+            username='testuser', email='test@example.com', password='testpass123', phone='+254712345678'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @override_settings(AI_PROVIDER='stub')
+    def test_cache_hit_skips_the_provider(self):
+        question = Question.objects.create(
+            user=self.user, type='text', content='what is 2+2', subject='Mathematics', grade_level='Grade 1'
+        )
+        with mock.patch.object(StubProvider, 'complete') as complete:
+            process_question_async(question.id)
+        complete.assert_not_called()
+
+        question.refresh_from_db()
+        self.assertEqual(question.ai_response, 'Four.')
+        self.assertEqual(question.explanation, '2 + 2 = 4')
+        self.assertEqual(question.step_by_step, self.CACHED['steps'])
+        self.assertIsNotNone(question.processing_time)
+        self.assertEqual(question.prompt_tokens, 0)
+
+    @override_settings(AI_PROVIDER='stub')
+    def test_clients_can_skip_the_cache(self):
+        def run_now(args, kwargs, **options):
+            process_question_async(*args, **kwargs)
+
+        question_data = {'type': 'text', 'content': 'What is 2 + 2?', 'subject': 'Mathematics', 'grade_level': 'Grade 1'}
+        with mock.patch.object(process_question_async, 'apply_async', side_effect=run_now):
+            for url, headers in [
+                ('/api/questions/', {}),
+                ('/api/questions/?nocache=1', {}),
+                ('/api/questions/', {'HTTP_CACHE_CONTROL': 'no-cache'}),
+            ]:
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.client.post(url, question_data, **headers)
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        answers = list(Question.objects.order_by('id').values_list('ai_response', flat=True))
+        self.assertEqual(answers[0], 'Four.')
+        for answer in answers[1:]:
+            self.assertTrue(answer.startswith("Let's work through this together"))
+
+    @override_settings(AI_PROVIDER='stub')
+    def test_stream_can_skip_the_cache(self):
+        questions = [
+            Question.objects.create(
+                user=self.user, type='text', content='What is 2 + 2?', subject='Mathematics', grade_level='Grade 1'
+            )
+            for _ in range(2)
+        ]
+        for question, query in zip(questions, ['', '?nocache=1']):
+            response = self.client.get(
+                f'/api/questions/{question.question_id}/stream/{query}', HTTP_ACCEPT='text/event-stream'
+            )
+            b''.join(response.streaming_content)
+
+        cached, fresh = Question.objects.filter(pk__in=[q.pk for q in questions]).order_by('id')
+        self.assertEqual(cached.ai_response, 'Four.')
+        self.assertEqual(fresh.ai_response, "Let's work through this together.")
+
+    def test_stats_count_hits_and_misses(self):
+        self.answer_cache.cache.delete_many([AnswerCache.HITS_KEY, AnswerCache.MISSES_KEY])
+        self.assertIsNone(self.answer_cache.get('What is 3 + 3?', 'Mathematics', 'Grade 1'))
+        self.assertEqual(self.answer_cache.get('What is 2+2', 'mathematics', 'grade 1'), self.CACHED)
+        self.answer_cache.get('What is 2 + 2?', 'Mathematics', 'Grade 1')
+        self.assertEqual(self.answer_cache.stats(), {'hits': 2, 'misses': 1, 'hit_ratio': 0.6667})
+
+class SubscriptionExpiryTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.lapsed = User.objects.create_user(
+            username='lapsed', email='lapsed@example.com', password='testpass123',
+            phone='+254712345678', subscription_type='monthly', subscription_end_date=now - timedelta(days=1)
+        )
+        self.renewed = User.objects.create_user(
+            username='renewed', email='renewed@example.com', password='testpass123',
+            phone='+254712345679', subscription_type='monthly', subscription_end_date=now + timedelta(days=29)
+        )
+        for user in (self.lapsed, self.renewed):
+            Subscription.objects.create(user=user, plan_type='monthly', amount=500, end_date=now - timedelta(days=1))
+        Subscription.objects.create(user=self.renewed, plan_type='monthly', amount=500, end_date=now + timedelta(days=29))
+
+    @override_settings(SUBSCRIPTION_EXPIRY_BATCH_SIZE=1)
+    def test_expires_in_chunks(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            totals = process_expired_subscriptions()
+
+        self.assertEqual(totals, {'subscriptions': 2, 'users': 1})
+        self.assertEqual(Subscription.objects.filter(status='active').count(), 1)
+
+        self.lapsed.refresh_from_db()
+        self.assertEqual(self.lapsed.subscription_type, 'free')
+        self.assertEqual(credits.get_balance(self.lapsed.id), 0)
+
+        self.renewed.refresh_from_db()
+        self.assertEqual(self.renewed.subscription_type, 'monthly')
+
+        # A second run finds nothing left to do
+        self.assertEqual(process_expired_subscriptions(), {'subscriptions': 0, 'users': 0})
+
+@override_settings(SUBSCRIPTION_EXPIRY_BATCH_SIZE=5, CREDIT_LEDGER_COMPACTION_BATCH=7)
+class SubscriptionExpiryConcurrencyTestCase(TransactionTestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.users = []
+        for index in range(30):
+            user = User.objects.create_user(
+                username=f'lapsed{index}', email=f'lapsed{index}@example.com', password='testpass123',
+                phone='+254712345678', subscription_type='monthly', subscription_end_date=now - timedelta(days=1)
+            )
+            Subscription.objects.create(user=user, plan_type='monthly', amount=500, end_date=now - timedelta(days=1))
+            for _ in range(3):
+                credits.record(user.pk, 5, 'purchase')
+            self.users.append(user)
+
+    def test_expiry_and_compaction_run_together(self):
+        errors = []
+
+        def run(task):
+            try:
+                task()
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=run, args=(task,))
+            for task in (process_expired_subscriptions, compact_credit_ledger) * 2
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertFalse(User.objects.filter(pk__in=[user.pk for user in self.users]).exclude(credits=0).exists())
+        self.assertFalse(User.objects.filter(subscription_type='monthly').exists())
+        for user in self.users:
+            credits.forget_balance(user.pk)
+            self.assertEqual(credits.get_balance(user.pk), 0)
+
+class UsageReportTestCase(TestCase):
+    def setUp(self):
+        get_redis().delete(rollups.DIRTY_DAYS_KEY)
+        self.user = User.objects.create_user(
+            username='testuser', email='test@example.com', password='testpass123', phone='+254712345678'
+        )
+        self.yesterday = timezone.now() - timedelta(days=1)
+        for n in range(3):
+            question = Question.objects.create(
+                user=self.user, type='text', content=f'Question {n}', subject='Mathematics',
+                grade_level='Grade 3', cost=10, processing_time=1000 * (n + 1)
+            )
+            Question.objects.filter(pk=question.pk).update(created_at=self.yesterday)
+        rollups.mark_dirty(self.yesterday)
+
+    def test_dirty_days_are_rebuilt(self):
+        day = timezone.localdate(self.yesterday)
+        self.assertEqual(rollups.refresh_rollups(), [day.isoformat()])
+        rollup = DailyUsageRollup.objects.get(day=day)
+        self.assertEqual((rollup.questions, rollup.unique_users, rollup.revenue), (3, 1, 30))
+        self.assertEqual(rollup.average_processing_time, 2000)
+        # Nothing left to do
+        self.assertEqual(rollups.refresh_rollups(), [])
+
+    def test_failed_rebuild_stays_dirty(self):
+        with mock.patch.object(rollups, 'rebuild_day', side_effect=RuntimeError('database went away')):
+            with self.assertRaises(RuntimeError):
+                rollups.refresh_rollups()
+        self.assertEqual(len(rollups.refresh_rollups()), 1)
+        self.assertTrue(DailyUsageRollup.objects.exists())
+
+    def test_usage_endpoint_reads_rollups(self):
+        rollups.refresh_rollups()
+        day = timezone.localdate(self.yesterday)
+        admin = User.objects.create_user(
+            username='admin', email='admin@example.com', password='testpass123', phone='+254712345679', is_staff=True
+        )
+        client = APIClient()
+        client.force_authenticate(user=admin)
+
+        response = client.get(f'/api/system/usage/?start={day}&end={day}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['days'], [{
+            'day': day, 'questions': 3, 'revenue': 30, 'average_processing_time': 2000
+        }])
+        self.assertEqual(rollups.usage_summary(day, day)[0]['processed_questions'], 3)
+
+        response = client.get('/api/system/usage/?start=yesterday')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        client.force_authenticate(user=self.user)
+        self.assertEqual(client.get('/api/system/usage/').status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_daily_report_is_mailed(self):
+        send_daily_usage_report()
+        self.assertEqual(mail.outbox[0].to, ['admin@homeworkhelper.com'])
+        self.assertIn('Questions Asked: 3', mail.outbox[0].body)
+        self.assertIn('Revenue Generated: KES 30', mail.outbox[0].body)
+
+@override_settings(MAIL_BATCH_SIZE=2)
+class SubscriptionReminderTestCase(TestCase):
+    def setUp(self):
+        end_date = timezone.now() + timedelta(days=3)
+        for index in range(3):
+            user = User.objects.create_user(
+                username=f'parent{index}', email=f'parent{index}@example.com',
+                password='testpass123', phone='+254712345678'
+            )
+            Subscription.objects.create(user=user, plan_type='monthly', amount=500, end_date=end_date, auto_renew=False)
+
+    def test_reminders_are_batched(self):
+        # Run the mail batches in-process instead of on a worker
+        with mock.patch.object(send_mail_batch, 'delay', side_effect=send_mail_batch) as delay:
+            self.assertEqual(send_subscription_reminders(), 3)
+        self.assertEqual(delay.call_count, 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), [
+            'parent0@example.com', 'parent1@example.com', 'parent2@example.com'
+        ])
+
+class ImagingTestCase(TestCase):
+    def test_prepare_image_crops_and_shrinks(self):
+        # A large photo of a page with the writing in the top-left corner
+        image = Image.new('RGB', (4000, 3000), 'white')
+        ImageDraw.Draw(image).rectangle((100, 100, 1100, 600), fill='black')
+        upload = io.BytesIO()
+        image.save(upload, format='PNG')
+
+        prepared = prepare_image(upload)
+        self.assertLessEqual(len(prepared), 300 * 1024)
+        with Image.open(io.BytesIO(prepared)) as result:
+            self.assertEqual(result.format, 'JPEG')
+            # Cropped to the writing plus a small margin
+            self.assertLess(result.width, 1100)
+            self.assertLess(result.height, 600)
+
+class StubAIServer:
+    """Local OpenAI- and Claude-compatible endpoint that can be made slow or failing"""
+
+    def __init__(self, text, delay=0, status_code=200):
+        self.text, self.delay, self.status_code = text, delay, status_code
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                server.requests += 1
+                time.sleep(server.delay)
+                if self.path.endswith('/chat/completions'):
+                    body = {'choices': [{'message': {'content': server.text}}]}
+                else:
+                    body = {'content': [{'type': 'text', 'text': server.text}]}
+                data = json.dumps(body).encode()
+                self.send_response(server.status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class ProviderRouterTestCase(SimpleTestCase):
+    def start_server(self, text, **kwargs):
+        server = StubAIServer(text, **kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def test_slow_backend_is_hedged(self):
+        openai = self.start_server('openai answer', delay=2)
+        claude = self.start_server('claude answer')
+        with self.settings(
+            OPENAI_API_BASE=openai.url, CLAUDE_API_BASE=claude.url,
+            AI_ROUTER_BACKENDS=['openai', 'claude'], AI_ROUTER_HEDGE_DELAY=0.2
+        ):
+            router = RouterProvider()
+            start = time.monotonic()
+            self.assertEqual(router.complete('What is 2 + 2?').text, 'claude answer')
+            self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(openai.requests, 1)
+
+    def test_failing_backend_trips_breaker(self):
+        openai = self.start_server('', status_code=500)
+        with self.settings(
+            OPENAI_API_BASE=openai.url, AI_ROUTER_BACKENDS=['openai'],
+            AI_ROUTER_BREAKER_FAILURES=2, AI_ROUTER_BREAKER_COOLDOWN=60
+        ):
+            router = RouterProvider()
+            for _ in range(3):
+                with self.assertRaises(ProviderUnavailable):
+                    router.complete('What is 2 + 2?')
+            # The third call never reached the open circuit
+            self.assertEqual(openai.requests, 2)
+            self.assertEqual(router.describe()['openai']['state'], 'open')
+
+    def test_half_open_probe_is_kept_for_a_real_call(self):
+        openai = self.start_server('openai answer')
+        claude = self.start_server('claude answer')
+        with self.settings(
+            OPENAI_API_BASE=openai.url, CLAUDE_API_BASE=claude.url,
+            AI_ROUTER_BACKENDS=['openai', 'claude'], AI_ROUTER_BREAKER_COOLDOWN=60
+        ):
+            router = RouterProvider()
+            router.stats['claude'].opened_at = time.monotonic() - 61
+            self.assertEqual(router.complete('What is 2 + 2?').text, 'openai answer')
+            with mock.patch.object(router.backends['openai'], 'stream', return_value=iter(['openai ', 'answer'])):
+                self.assertEqual(''.join(router.stream('What is 2 + 2?')), 'openai answer')
+            # Claude was never called, so its probe is still available
+            self.assertEqual(claude.requests, 0)
+            self.assertIsNone(router.stats['claude'].probe_started)
+            self.assertTrue(router.stats['claude'].allow())
+
 class ChildTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -144,6 +1343,40 @@ class ChildTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['results']), 1)
 
+    def test_question_etag_follows_child_name(self):
+        child = Child.objects.create(parent=self.user, name='Jane Doe', grade='Grade 3')
+        question = Question.objects.create(
+            user=self.user, child=child, type='text', content='What is 2 + 2?',
+            subject='Mathematics', grade_level='Grade 3'
+        )
+        etag = self.client.get(f'/api/questions/{question.pk}/')['ETag']
+
+        self.client.patch(f'/api/children/{child.pk}/', {'name': 'Jane Smith'})
+        response = self.client.get(f'/api/questions/{question.pk}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['child_name'], 'Jane Smith')
+
+        etag = response['ETag']
+        child.delete()
+        response = self.client.get(f'/api/questions/{question.pk}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_conditional_get(self):
+        etag = self.client.get('/api/children/')['ETag']
+
+        response = self.client.get('/api/children/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Adding a child changes both the children list and the profile
+        profile_etag = self.client.get('/api/auth/profile/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/children/', {'name': 'Jane Doe', 'grade': 'Grade 3'})
+
+        response = self.client.get('/api/children/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get('/api/auth/profile/', HTTP_IF_NONE_MATCH=profile_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
 # ================================
 # Dockerfile
 """
@@ -226,6 +1459,19 @@ services:
       - DB_PORT=5432
       - REDIS_URL=redis://redis:6379
 
+  celery-images:
+    build: .
+    command: celery -A homework_helper_project worker -Q images --concurrency=2 --loglevel=info
+    volumes:
+      - .:/app
+    depends_on:
+      - db
+      - redis
+    environment:
+      - DB_HOST=db
+      - DB_PORT=5432
+      - REDIS_URL=redis://redis:6379
+
   celery-beat:
     build: .
     command: celery -A homework_helper_project beat --loglevel=info
@@ -281,6 +1527,7 @@ pip install -r requirements.txt
 
 ### 4. Set up environment variables
 Create a `.env` file in the project root with the required variables (see .env example above).
+Set `AI_PROVIDER=stub` to answer questions offline with canned text.
 
 ### 5. Run migrations
 ```bash
@@ -302,8 +1549,10 @@ python manage.py runserver
 ### Authentication
 - `POST /api/auth/register/` - User registration
 - `POST /api/auth/login/` - User login
+- `POST /api/auth/logout/` - Revoke the current token
 - `GET /api/auth/profile/` - Get user profile
 - `PUT /api/auth/profile/` - Update user profile
+- `GET /api/auth/entitlements/` - Current plan, remaining questions, expiry and per-question cost
 
 ### Children Management
 - `GET /api/children/` - List user's children
@@ -312,21 +1561,42 @@ python manage.py runserver
 - `PUT /api/children/{id}/` - Update child
 - `DELETE /api/children/{id}/` - Delete child
 
+Profile, children and question detail responses carry an `ETag` (and `Last-Modified` for questions). Send it back in `If-None-Match` / `If-Modified-Since` to get an empty `304 Not Modified` when nothing has changed.
+
 ### Questions
-- `GET /api/questions/` - List user's questions
-- `POST /api/questions/` - Submit a new question
+- `GET /api/questions/` - List user's questions (compact; add `expand=ai_response,explanation,step_by_step` for answer bodies and `fields=id,subject,...` to trim)
+- `POST /api/questions/` - Submit a new question (returns 202 with the `question_id`; answered in the background)
+- `GET /api/questions/{uuid}/status/` - Poll answer status (`queued`, `processing`, `done`)
+- `GET /api/questions/{uuid}/stream/` - Stream the answer as Server-Sent Events (`token` events, then a final `done` event with the saved answer)
+
+Questions are answered through a provider router (`AI_PROVIDER=router`, backends in `AI_ROUTER_BACKENDS`). It prefers the fastest healthy backend, sends a hedged request to the next one when an answer passes the backend's p95 latency, and takes a backend out of rotation for `AI_ROUTER_BREAKER_COOLDOWN` seconds after repeated failures. Per-backend stats appear under `ai_providers` in `/api/system/stats/`.
+
+Prompts are built from templates per subject family and grade band. Overlong questions are truncated to `PROMPT_MAX_QUESTION_TOKENS`, and the predicted difficulty sets the answer's token budget and model tier (`PROMPT_BUDGETS`). Each question records `prompt_tokens` and `completion_tokens` (0 when answered from the cache).
+
+Models are asked for a JSON answer (`summary`, `explanation`, `steps`, `difficulty`, `tip`), which `answers.parse_answer` splits into `explanation`, `step_by_step` and `difficulty`; code fences, stray text and plain-prose answers (as streamed) are handled too. Filter the history with `GET /api/questions/?difficulty=hard` (or `child=<id>`).
+
+Identical questions (same subject and grade, ignoring case, spacing, punctuation and number formatting) are answered from a shared Redis cache. Send `?nocache=1` or `Cache-Control: no-cache` with the POST to force a fresh answer.
 - `GET /api/questions/{id}/` - Get question details
+- `GET /api/questions/{id}/image/` - The uploaded image (owner only; `image` in question responses links here)
+- `GET /api/questions/{id}/image/{size}/` - A thumbnail (`small`, `medium`), linked from `thumbnails` once generated
 - `PUT /api/questions/{id}/` - Update question
 - `POST /api/questions/{uuid}/rate/` - Rate a question
 
+Question, payment and subscription lists are cursor-paginated, newest first: follow the `next`/`previous` links. Add `order=asc` for oldest first, `page_size` (max 100) to change the page length, or `page=N` for the old page-number responses.
+
 ### Payments
 - `GET /api/payments/` - List user's payments
 - `POST /api/payments/` - Create a payment
+- `POST /api/mpesa/callback/` - Safaricom STK push callback (queued and applied in batches)
 
 ### Subscriptions
 - `GET /api/subscriptions/` - List user's subscriptions
 - `POST /api/subscriptions/` - Create a subscription
 
+### Operations (staff only)
+- `GET /api/system/stats/` - Answer and auth cache hit/miss counters, pending notifications per channel
+- `GET /api/system/usage/?start=YYYY-MM-DD&end=YYYY-MM-DD` - Daily questions, revenue and processing time from the usage rollups
+
 ## Pricing Structure
 - Free Tier: 3 questions per month
 - Pay-per-use: KES 10 per question
@@ -349,7 +1619,7 @@ python manage.py test
 ## Background Tasks
 The application uses Celery for background tasks:
 - Question processing with AI
-- Email notifications
+- Email notifications (sent in batches over one SMTP connection, `MAIL_BATCH_SIZE` messages each, at most `MAIL_BATCH_RATE_LIMIT` batches per worker)
 - Usage analytics
 - Subscription management
 
@@ -358,6 +1628,26 @@ Start Celery worker:
 celery -A homework_helper_project worker --loglevel=info
 ```
 
+Image questions are preprocessed (rotated, cropped, downscaled) and OCR'd on a separate `images` queue. Uploads are hashed while they stream in and stored once per distinct image (`question_images/<digest>`), and answers for an image already seen with the same subject, grade and text come from the answer cache:
+```bash
+celery -A homework_helper_project worker -Q images --concurrency=2 --loglevel=info
+```
+Set `IMAGE_TEXT_EXTRACTOR=tesseract` (requires `pytesseract` and the Tesseract binary) for real OCR; the default `stub` extractor returns `IMAGE_STUB_TEXT`.
+
+In production set `MEDIA_OFFLOAD=x-accel` so nginx sends question images after Django has checked ownership. Don't expose `MEDIA_ROOT` publicly; map it to an internal location instead:
+```nginx
+location /protected-media/ {
+    internal;
+    alias /app/media/;
+}
+```
+
+To test mail locally, run an SMTP sink and point the app at it:
+```bash
+python -m aiosmtpd -n -l localhost:1025
+EMAIL_HOST=localhost EMAIL_PORT=1025 EMAIL_USE_TLS=False celery -A homework_helper_project worker --loglevel=info
+```
+
 Start Celery beat (scheduler):
 ```bash
 celery -A homework_helper_project beat --loglevel=info
@@ -0,0 +1,86 @@
+import os
+import threading
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+_lock = threading.Lock()
+_sessions = {}
+_redis = None
+_owner_pid = None
+
+
+class TimeoutSession(requests.Session):
+    """requests.Session that applies a default timeout to every call"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def get_http_session(name):
+    """Return the process-wide keep-alive session for an upstream service.
+
+    Sessions are shared by every thread (or greenlet) in the process and are
+    rebuilt after a fork so Celery prefork children and preloaded gunicorn
+    workers never share sockets with their parent.
+    """
+    _check_pid()
+    session = _sessions.get(name)
+    if session is None:
+        with _lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = _sessions[name] = _build_session(name)
+    return session
+
+
+def get_redis():
+    """Return the process-wide Redis client for queues, counters and locks"""
+    global _redis
+    _check_pid()
+    if _redis is None:
+        with _lock:
+            if _redis is None:
+                _redis = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def reset_clients():
+    """Close and forget every pooled session in this process"""
+    global _redis
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _redis = None
+
+
+def _build_session(name):
+    config = {**settings.HTTP_CLIENT_DEFAULTS, **settings.HTTP_CLIENTS.get(name, {})}
+    session = TimeoutSession(timeout=(config['connect_timeout'], config['read_timeout']))
+    adapter = HTTPAdapter(
+        pool_connections=config['pool_connections'],
+        pool_maxsize=config['pool_maxsize'],
+        pool_block=config['pool_block']
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _check_pid():
+    global _owner_pid, _redis
+    pid = os.getpid()
+    if _owner_pid != pid:
+        with _lock:
+            if _owner_pid != pid:
+                # Inherited from the parent process: drop without closing its sockets
+                _sessions.clear()
+                _redis = None
+                _owner_pid = pid
@@ -0,0 +1,164 @@
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Coalesce
+from .clients import get_redis
+from .conditional import invalidate_profiles
+from .models import User, CreditTransaction
+
+# Live balances are Redis counters seeded from the database ledger. Debits are a
+# single atomic script, so parallel submissions never read-modify-write the
+# User row and a balance can't go below zero.
+BALANCE_KEY = 'credits:balance:{user_id}'
+
+DEBIT_SCRIPT = """
+local balance = redis.call('GET', KEYS[1])
+if not balance then
+    return -1
+end
+if tonumber(balance) < tonumber(ARGV[1]) then
+    return -2
+end
+return redis.call('DECRBY', KEYS[1], ARGV[1])
+"""
+
+CREDIT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+NOT_SEEDED = -1
+
+
+def get_balance(user_id):
+    balance = get_redis().get(_key(user_id))
+    if balance is None:
+        return _seed(user_id)
+    return int(balance)
+
+
+def debit(user_id, amount=1):
+    """Atomically take `amount` credits if the balance covers it"""
+    result = _run(DEBIT_SCRIPT, user_id, amount)
+    if result == NOT_SEEDED:
+        _seed(user_id)
+        result = _run(DEBIT_SCRIPT, user_id, amount)
+    return result >= 0
+
+
+def refund(user_id, amount=1):
+    """Return credits taken by debit() when the work they paid for was not recorded"""
+    _run(CREDIT_SCRIPT, user_id, amount)
+
+
+def record(user_id, delta, reason, question=None, payment=None):
+    """Append a ledger entry. Debits must already have gone through debit()."""
+    return CreditTransaction.objects.create(
+        user_id=user_id,
+        delta=delta,
+        reason=reason,
+        question=question,
+        payment=payment
+    )
+
+
+def spend(user_id, amount=1, reason='question', question=None):
+    if not debit(user_id, amount):
+        return False
+    try:
+        record(user_id, -amount, reason, question=question)
+    except Exception:
+        refund(user_id, amount)
+        raise
+    return True
+
+
+def grant(entries):
+    """Record credit grants, given as CreditTransaction instances with positive deltas.
+
+    Call inside the transaction that justifies the grant; the live balances are
+    only raised once it commits.
+    """
+    CreditTransaction.objects.bulk_create(entries)
+
+    def apply_live_balances():
+        for entry in entries:
+            _run(CREDIT_SCRIPT, entry.user_id, entry.delta)
+    transaction.on_commit(apply_live_balances)
+
+
+def forget_balance(user_id):
+    """Drop the live counter so the next read re-seeds it from the database"""
+    get_redis().delete(_key(user_id))
+    invalidate_profiles([user_id])
+
+
+def reset_balances(user_ids):
+    """Zero the balances of several users. Call inside a transaction, before
+    touching their User rows, so locks are taken in compact_ledger()'s order.
+    """
+    # Entries, then users, each in id order, so the two never deadlock
+    entry_ids = list(
+        CreditTransaction.objects.select_for_update()
+        .filter(user_id__in=user_ids, is_compacted=False)
+        .order_by('id')
+        .values_list('id', flat=True)
+    )
+    CreditTransaction.objects.filter(id__in=entry_ids).update(is_compacted=True)
+    list(User.objects.select_for_update().filter(pk__in=user_ids).order_by('pk').values_list('pk', flat=True))
+    User.objects.filter(pk__in=user_ids).update(credits=0)
+
+    def forget_live_balances():
+        get_redis().delete(*[_key(user_id) for user_id in user_ids])
+        invalidate_profiles(user_ids)
+    transaction.on_commit(forget_live_balances)
+
+
+def compact_ledger(batch_size=1000):
+    """Fold uncompacted ledger entries into User.credits. Returns entries compacted."""
+    with transaction.atomic():
+        entries = list(
+            CreditTransaction.objects.select_for_update(skip_locked=True)
+            .filter(is_compacted=False)
+            .order_by('id')
+            .values_list('id', 'user_id', 'delta')[:batch_size]
+        )
+        if not entries:
+            return 0
+
+        totals = {}
+        for _, user_id, delta in entries:
+            totals[user_id] = totals.get(user_id, 0) + delta
+        for user_id in sorted(totals):
+            User.objects.filter(pk=user_id).update(credits=F('credits') + totals[user_id])
+        CreditTransaction.objects.filter(id__in=[entry[0] for entry in entries]).update(is_compacted=True)
+    return len(entries)
+
+
+def _db_balance(user_id):
+    # One statement, so a concurrent compaction is seen entirely or not at all
+    credits, pending = User.objects.filter(pk=user_id).annotate(
+        pending=Coalesce(
+            Sum('credit_transactions__delta', filter=Q(credit_transactions__is_compacted=False)),
+            0
+        )
+    ).values_list('credits', 'pending').get()
+    return credits + pending
+
+
+def _seed(user_id):
+    redis_client = get_redis()
+    redis_client.set(_key(user_id), _db_balance(user_id), nx=True)
+    return int(redis_client.get(_key(user_id)))
+
+
+def _run(script, user_id, amount):
+    result = get_redis().eval(script, 1, _key(user_id), amount)
+    # The balance is part of the profile body
+    invalidate_profiles([user_id])
+    return result
+
+
+def _key(user_id):
+    return BALANCE_KEY.format(user_id=user_id)
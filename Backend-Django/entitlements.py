@@ -0,0 +1,100 @@
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from . import credits
+from .models import User
+
+# Snapshots live in Redis and, for a few seconds, in process memory. Signals
+# drop both when a subscription, payment or plan field changes; other
+# processes pick the change up when their local copy expires.
+CACHE_KEY = 'entitlement:{user_id}'
+
+UNLIMITED_PLANS = ('monthly', 'family')
+
+_local = {}
+_local_lock = threading.Lock()
+
+
+def get_entitlement(user_id, include_balance=False):
+    """Return what the user may do right now.
+
+    Keys: plan, status, uses_credits, cost_per_question, expires_at and, when
+    include_balance is set, remaining_quota (None for unlimited plans).
+    """
+    snapshot = _get_local(user_id)
+    if snapshot is None:
+        snapshot = cache.get(_key(user_id))
+        if snapshot is None:
+            snapshot = _build(user_id)
+            cache.set(_key(user_id), snapshot, settings.ENTITLEMENT_CACHE_TTL)
+        _set_local(user_id, snapshot)
+
+    entitlement = _enforce_expiry(snapshot)
+    if include_balance:
+        entitlement['remaining_quota'] = (
+            credits.get_balance(user_id) if entitlement['uses_credits'] else None
+        )
+    return entitlement
+
+
+def invalidate(user_ids):
+    keys = [_key(user_id) for user_id in user_ids]
+    with _local_lock:
+        for user_id in user_ids:
+            _local.pop(user_id, None)
+    cache.delete_many(keys)
+
+
+def _build(user_id):
+    user = User.objects.only(
+        'subscription_type', 'subscription_status', 'subscription_end_date'
+    ).get(pk=user_id)
+    plan = user.subscription_type
+    unlimited = plan in UNLIMITED_PLANS
+    if unlimited and user.subscription_status != 'active':
+        return _free_snapshot(user.subscription_status)
+    return {
+        'plan': plan,
+        'status': user.subscription_status,
+        'uses_credits': not unlimited,
+        'cost_per_question': settings.PRICE_PER_QUESTION if plan == 'pay-per-use' else 0,
+        'expires_at': user.subscription_end_date if unlimited else None,
+    }
+
+
+def _enforce_expiry(snapshot):
+    # Expiry is checked on every read, so it applies before the nightly sweep runs
+    expires_at = snapshot['expires_at']
+    if expires_at is not None and expires_at <= timezone.now():
+        return _free_snapshot('expired')
+    return dict(snapshot)
+
+
+def _free_snapshot(status):
+    return {
+        'plan': 'free',
+        'status': status,
+        'uses_credits': True,
+        'cost_per_question': 0,
+        'expires_at': None,
+    }
+
+
+def _get_local(user_id):
+    entry = _local.get(user_id)
+    if entry is None or entry[0] < time.monotonic():
+        return None
+    return entry[1]
+
+
+def _set_local(user_id, snapshot):
+    with _local_lock:
+        if len(_local) >= settings.ENTITLEMENT_LOCAL_MAX_ENTRIES:
+            _local.clear()
+        _local[user_id] = (time.monotonic() + settings.ENTITLEMENT_LOCAL_TTL, snapshot)
+
+
+def _key(user_id):
+    return CACHE_KEY.format(user_id=user_id)
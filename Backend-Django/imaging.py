@@ -0,0 +1,102 @@
+import io
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from PIL import Image, ImageChops, ImageOps
+
+# Image questions run on their own Celery queue (IMAGE_QUESTION_QUEUE), so
+# decoding and OCR never hold up the workers answering text questions.
+
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def prepare_image(image_file):
+    """Decode an upload and return it as JPEG bytes within IMAGE_MAX_BYTES.
+
+    The image is turned upright, cropped to its content and scaled so its
+    longer side is at most IMAGE_MAX_DIMENSION.
+    """
+    image_file.seek(0)
+    with Image.open(image_file) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+    image = crop_to_content(image)
+    image.thumbnail((settings.IMAGE_MAX_DIMENSION, settings.IMAGE_MAX_DIMENSION), Image.Resampling.LANCZOS)
+    return encode_within_budget(image, settings.IMAGE_MAX_BYTES)
+
+
+def crop_to_content(image, margin=16):
+    # Anything that differs noticeably from the corner colour counts as content
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    difference = ImageChops.difference(image, background).convert('L')
+    bbox = difference.point(lambda value: 255 if value > 24 else 0).getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((
+        max(left - margin, 0),
+        max(top - margin, 0),
+        min(right + margin, image.width),
+        min(bottom + margin, image.height)
+    ))
+
+
+def encode_within_budget(image, max_bytes):
+    # Lower the quality first, then the size, until the JPEG fits
+    while True:
+        for quality in (85, 75, 65, 55):
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality, optimize=True)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue()
+        if min(image.size) <= 64:
+            return buffer.getvalue()
+        image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.Resampling.LANCZOS)
+
+
+class StubTextExtractor:
+    """Offline extractor for development and tests; returns IMAGE_STUB_TEXT"""
+
+    def extract(self, image_bytes):
+        return settings.IMAGE_STUB_TEXT
+
+
+class TesseractTextExtractor:
+    """OCR with a local Tesseract install (needs the optional pytesseract package)"""
+
+    def __init__(self):
+        try:
+            import pytesseract
+        except ImportError:
+            raise ImproperlyConfigured('TesseractTextExtractor requires the pytesseract package')
+        self.pytesseract = pytesseract
+
+    def extract(self, image_bytes):
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            return self.pytesseract.image_to_string(image.convert('L'))
+
+
+def get_text_extractor(name=None):
+    """Return the shared text extractor instance"""
+    name = name or settings.IMAGE_TEXT_EXTRACTOR
+    extractor = _extractors.get(name)
+    if extractor is None:
+        with _extractors_lock:
+            extractor = _extractors.get(name)
+            if extractor is None:
+                extractor = _extractors[name] = import_string(settings.IMAGE_TEXT_EXTRACTORS[name])()
+    return extractor
+
+
+def make_thumbnail(image_file, max_side):
+    """JPEG bytes of an upright copy no larger than max_side on either side"""
+    image_file.seek(0)
+    with Image.open(image_file) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=80, optimize=True)
+    return buffer.getvalue()
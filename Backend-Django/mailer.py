@@ -0,0 +1,70 @@
+import logging
+import smtplib
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+logger = logging.getLogger(__name__)
+
+# Messages travel as plain dicts ({'to', 'subject', 'body'}) so they can be
+# queued as Celery task arguments. A batch is sent over one SMTP connection.
+
+
+def message(to, subject, body):
+    return {'to': to, 'subject': subject, 'body': body}
+
+
+def chunks(messages, size=None):
+    size = size or settings.MAIL_BATCH_SIZE
+    for start in range(0, len(messages), size):
+        yield messages[start:start + size]
+
+
+def send_batch(messages):
+    """Send messages over one reused connection. Returns (sent, failed recipients)."""
+    results = send_each(messages)
+    failed = [item['to'] for item, ok in zip(messages, results) if not ok]
+    return sum(results), failed
+
+
+def send_each(messages):
+    """Send messages over one reused connection. Returns a success flag per message.
+
+    A rejected recipient only fails its own message; a dropped connection is
+    reopened and the message retried once.
+    """
+    connection = get_connection(fail_silently=False)
+    results = []
+    connection.open()
+    try:
+        for item in messages:
+            email = EmailMessage(
+                subject=item['subject'],
+                body=item['body'],
+                from_email=settings.EMAIL_HOST_USER,
+                to=[item['to']],
+                connection=connection
+            )
+            try:
+                results.append(bool(_send(connection, email)))
+            except (smtplib.SMTPException, OSError) as exc:
+                logger.warning('Mail to %s failed: %s', item['to'], exc)
+                results.append(False)
+    finally:
+        connection.close()
+    return results
+
+
+def _send(connection, email):
+    try:
+        return connection.send_messages([email])
+    except smtplib.SMTPServerDisconnected:
+        connection.close()
+        connection.open()
+        return connection.send_messages([email])
+
+
+def queue(messages):
+    """Fan messages out to the mail workers in batches"""
+    from .tasks import send_mail_batch
+    for batch in chunks(list(messages)):
+        send_mail_batch.delay(batch)
@@ -0,0 +1,26 @@
+import mimetypes
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import patch_cache_control
+
+# Protected media is checked by a view and then handed to the web server
+# (MEDIA_OFFLOAD = 'x-accel' for nginx, 'x-sendfile' for Apache/lighttpd), so
+# workers never copy file bytes. 'django' streams the file itself, for development.
+
+
+def protected_file_response(name):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    mode = settings.MEDIA_OFFLOAD
+    if mode == 'x-accel':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = f"{settings.MEDIA_OFFLOAD_PREFIX}{name}"
+    elif mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = default_storage.path(name)
+    else:
+        response = FileResponse(default_storage.open(name), content_type=content_type)
+
+    # URLs carry the content digest, so a cached copy never goes stale
+    patch_cache_control(response, private=True, max_age=settings.MEDIA_CACHE_MAX_AGE, immutable=True)
+    return response
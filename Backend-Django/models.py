@@ -34,7 +34,7 @@ class User(AbstractUser):
     credits = models.IntegerField(default=3)  # Free tier gets 3 questions
     total_spent = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
-    last_login = models.DateTimeField(auto_now=True)
+    last_login = models.DateTimeField(null=True, blank=True)  # written in bulk from activity tracking
     
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'phone']
@@ -49,6 +49,18 @@ class Child(models.Model):
     def __str__(self):
         return f"{self.name} - Grade {self.grade}"
 
+class ImageBlob(models.Model):
+    """An uploaded image stored once under its SHA-256 digest and shared by questions"""
+    digest = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='question_images/', max_length=255)
+    size = models.PositiveIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    thumbnails = models.JSONField(default=dict)  # {size name: storage name}, filled in the background
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.digest[:12]} ({self.ref_count} refs)"
+
 class Question(models.Model):
     TYPE_CHOICES = [
         ('text', 'Text'),
@@ -61,11 +73,18 @@ class Question(models.Model):
         ('hard', 'Hard'),
     ]
     
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+    ]
+    
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='questions')
     question_id = models.UUIDField(default=uuid.uuid4, unique=True)
     type = models.CharField(max_length=10, choices=TYPE_CHOICES)
     content = models.TextField()
-    image = models.ImageField(upload_to='question_images/', null=True, blank=True)
+    image = models.ImageField(upload_to='question_images/', max_length=255, null=True, blank=True)
+    image_blob = models.ForeignKey(ImageBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='questions')
     subject = models.CharField(max_length=100)
     grade_level = models.CharField(max_length=20)
     child = models.ForeignKey(Child, on_delete=models.SET_NULL, null=True, blank=True)
@@ -74,22 +93,102 @@ class Question(models.Model):
     step_by_step = models.JSONField(default=list)
     difficulty = models.CharField(max_length=10, choices=DIFFICULTY_CHOICES, null=True)
     processing_time = models.IntegerField(null=True)  # in milliseconds
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)  # 0 when answered from cache
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True)
     rating = models.IntegerField(
         validators=[MinValueValidator(1), MaxValueValidator(5)], 
         null=True, blank=True
     )
     feedback = models.TextField(null=True, blank=True)
     cost = models.DecimalField(max_digits=6, decimal_places=2, default=0)
+    plan = models.CharField(max_length=20, choices=User.SUBSCRIPTION_TYPES, default='free')  # plan at submission
     is_processed = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='question_user_created_idx'),
+            models.Index(fields=['user', 'difficulty', '-created_at', '-id'], name='question_user_difficulty_idx'),
+            models.Index(fields=['created_at'], name='question_created_idx'),  # rollup day scans
+            models.Index(fields=['subject', 'grade_level'], name='question_subject_grade_idx'),
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(is_processed=False),
+                name='question_unprocessed_idx'
+            ),
+        ]
     
     def __str__(self):
         return f"Question {self.question_id} - {self.subject}"
 
+class DailyUsageRollup(models.Model):
+    """Question activity per day, subject, grade and plan, rebuilt by the rollup task"""
+    day = models.DateField()
+    subject = models.CharField(max_length=100)
+    grade_level = models.CharField(max_length=20)
+    plan = models.CharField(max_length=20, choices=User.SUBSCRIPTION_TYPES)
+    questions = models.PositiveIntegerField(default=0)
+    unique_users = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    processed_questions = models.PositiveIntegerField(default=0)
+    processing_time_total = models.BigIntegerField(default=0)  # in milliseconds
+    rating_counts = models.JSONField(default=dict)  # {"1": count, ..., "5": count}
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'subject', 'grade_level', 'plan'],
+                name='unique_daily_usage_rollup'
+            ),
+        ]
+    
+    @property
+    def average_processing_time(self):
+        if not self.processed_questions:
+            return None
+        return round(self.processing_time_total / self.processed_questions)
+    
+    def __str__(self):
+        return f"{self.day} {self.subject} {self.grade_level} {self.plan}"
+
+class CreditTransaction(models.Model):
+    """Append-only credit ledger.
+
+    A user's balance is `User.credits` plus the deltas not yet compacted into it.
+    """
+    REASON_CHOICES = [
+        ('question', 'Question'),
+        ('purchase', 'Purchase'),
+        ('adjustment', 'Adjustment'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='credit_transactions')
+    delta = models.IntegerField()
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    question = models.ForeignKey(Question, on_delete=models.SET_NULL, null=True, blank=True)
+    payment = models.ForeignKey('Payment', on_delete=models.SET_NULL, null=True, blank=True)
+    is_compacted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # Ledger compaction walks uncompacted entries in id order
+            models.Index(
+                fields=['id'],
+                condition=models.Q(is_compacted=False),
+                name='credit_uncompacted_idx'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} {self.delta:+d} ({self.reason})"
+
 class Payment(models.Model):
     PAYMENT_METHODS = [
         ('mpesa', 'M-Pesa'),
@@ -116,11 +215,20 @@ class Payment(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     type = models.CharField(max_length=20, choices=TYPE_CHOICES)
     description = models.TextField(null=True, blank=True)
-    mpesa_receipt_number = models.CharField(max_length=50, null=True, blank=True)
+    mpesa_receipt_number = models.CharField(max_length=50, unique=True, null=True, blank=True)
+    checkout_request_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='payment_user_created_idx'),
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(status='pending'),
+                name='payment_pending_idx'
+            ),
+        ]
     
     def __str__(self):
         return f"Payment {self.transaction_id} - {self.amount} {self.currency}"
@@ -148,7 +256,62 @@ class Subscription(models.Model):
     
     class Meta:
         ordering = ['-start_date']
+        indexes = [
+            models.Index(fields=['user', '-start_date', '-id'], name='subscription_user_start_idx'),
+            # Expiry sweep: active subscriptions by end date, covering user_id
+            models.Index(
+                fields=['end_date'],
+                include=['user'],
+                condition=models.Q(status='active'),
+                name='subscription_active_end_idx'
+            ),
+        ]
     
     def __str__(self):
         return f"{self.user.email} - {self.plan_type} - {self.status}"
 
+class Notification(models.Model):
+    """Outbox of user notifications, written in the transaction that triggers them"""
+    CHANNEL_CHOICES = [
+        ('email', 'Email'),
+        ('push', 'Push'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    channel = models.CharField(max_length=20, choices=CHANNEL_CHOICES)
+    recipient = models.CharField(max_length=255)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    dedupe_key = models.CharField(max_length=100, unique=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # The dispatcher drains pending rows per channel in id order
+            models.Index(
+                fields=['channel', 'id'],
+                condition=models.Q(status='pending'),
+                name='notification_pending_idx'
+            ),
+            models.Index(
+                fields=['claimed_at'],
+                condition=models.Q(status='sending'),
+                name='notification_sending_idx'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.channel} to {self.recipient} ({self.status})"
+
@@ -0,0 +1,104 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, Value, When
+from django.utils import timezone
+from . import mailer
+from .models import Notification
+
+# Notifications are written to an outbox table in the same transaction as the
+# change they announce and sent later by dispatch(), batched per channel. The
+# dedupe key makes repeated writes (a retried task, say) a no-op.
+
+
+def add(user, channel, recipient, subject, body, dedupe_key):
+    # ignore_conflicts keeps a duplicate from aborting the surrounding transaction
+    Notification.objects.bulk_create([Notification(
+        user=user,
+        channel=channel,
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        dedupe_key=dedupe_key
+    )], ignore_conflicts=True)
+
+
+def question_answered(question):
+    user = question.user
+    add(
+        user,
+        channel='email',
+        recipient=user.email,
+        subject='Your homework question has been answered!',
+        body=f'''
+            Hi {user.first_name},
+
+            Your question about {question.subject} has been processed and answered.
+
+            Log in to your Homework Helper app to view the detailed explanation.
+
+            Question: {question.content[:100]}...
+
+            Best regards,
+            The Homework Helper Team
+            ''',
+        dedupe_key=f'question-answered:{question.pk}'
+    )
+
+
+def dispatch(channel, batch_size=None):
+    """Send one batch of pending notifications on a channel. Returns rows handled."""
+    batch_size = batch_size or settings.NOTIFICATION_DISPATCH_BATCH
+    now = timezone.now()
+    # Batches whose dispatcher died mid-send go back in the queue
+    Notification.objects.filter(
+        status='sending', claimed_at__lt=now - timedelta(seconds=settings.NOTIFICATION_CLAIM_TIMEOUT)
+    ).update(status='pending')
+
+    # Claim the batch and commit, so no row locks are held while sending
+    with transaction.atomic():
+        batch = list(
+            Notification.objects.select_for_update(skip_locked=True)
+            .filter(channel=channel, status='pending')
+            .order_by('id')[:batch_size]
+        )
+        if not batch:
+            return 0
+        Notification.objects.filter(pk__in=[n.pk for n in batch]).update(
+            status='sending', claimed_at=now, attempts=F('attempts') + 1
+        )
+
+    failed_ids = SENDERS[channel](batch)
+    sent = [n.pk for n in batch if n.pk not in failed_ids]
+    Notification.objects.filter(pk__in=sent).update(status='sent', sent_at=timezone.now())
+    if failed_ids:
+        # Give up on a notification after NOTIFICATION_MAX_ATTEMPTS tries
+        Notification.objects.filter(pk__in=failed_ids).update(status=Case(
+            When(attempts__gte=settings.NOTIFICATION_MAX_ATTEMPTS, then=Value('failed')),
+            default=Value('pending')
+        ))
+    return len(batch)
+
+
+def queue_depth():
+    """Pending notifications per channel"""
+    counts = dict(
+        Notification.objects.filter(status='pending')
+        .values_list('channel')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    return {channel: counts.get(channel, 0) for channel in SENDERS}
+
+
+def _send_email(batch):
+    results = mailer.send_each([
+        mailer.message(to=n.recipient, subject=n.subject, body=n.body) for n in batch
+    ])
+    return {n.pk for n, ok in zip(batch, results) if not ok}
+
+
+# Channel -> sender taking a batch and returning the ids of notifications that failed
+SENDERS = {
+    'email': _send_email,
+}
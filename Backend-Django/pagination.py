@@ -0,0 +1,112 @@
+import base64
+import json
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class HistoryPagination(BasePagination):
+    """Keyset pagination on (date, id) with opaque cursors.
+
+    Each page is a bounded index range scan that starts at the cursor, so page
+    500 costs the same as page 1 and rows inserted meanwhile never shift the
+    pages a client is walking. `?order=asc` walks oldest first. `?page=N`
+    keeps the old page-number responses while clients migrate.
+    """
+    ordering_field = 'created_at'
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.legacy = None
+        self.ascending = request.query_params.get('order') == 'asc'
+
+        if 'page' in request.query_params:
+            self.legacy = PageNumberPagination()
+            return self.legacy.paginate_queryset(self._order(queryset, self.ascending), request, view)
+
+        cursor = self._decode_cursor(request)
+        backwards = cursor is not None and cursor['backwards']
+        # Paging backwards scans the opposite way from the cursor, then flips the page
+        scan_ascending = self.ascending != backwards
+
+        queryset = self._order(queryset, scan_ascending)
+        if cursor is not None:
+            queryset = queryset.filter(self._after(cursor, scan_ascending))
+
+        page_size = self._page_size(request)
+        rows = list(queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backwards:
+            rows.reverse()
+
+        self.has_next = has_more if not backwards else True
+        self.has_previous = cursor is not None if not backwards else has_more
+        self.first, self.last = (rows[0], rows[-1]) if rows else (None, None)
+        return rows
+
+    def get_paginated_response(self, data):
+        if self.legacy is not None:
+            return self.legacy.get_paginated_response(data)
+        return Response({
+            'next': self._link(self.last, backwards=False) if self.has_next else None,
+            'previous': self._link(self.first, backwards=True) if self.has_previous else None,
+            'results': data,
+        })
+
+    def _order(self, queryset, ascending):
+        if ascending:
+            return queryset.order_by(self.ordering_field, 'id')
+        return queryset.order_by(f'-{self.ordering_field}', '-id')
+
+    def _after(self, cursor, ascending):
+        # (date, id) > cursor, written so the date bound becomes the index range start
+        field, value, row_id = self.ordering_field, cursor['value'], cursor['id']
+        if ascending:
+            return Q(**{f'{field}__gte': value}) & (Q(**{f'{field}__gt': value}) | Q(id__gt=row_id))
+        return Q(**{f'{field}__lte': value}) & (Q(**{f'{field}__lt': value}) | Q(id__lt=row_id))
+
+    def _page_size(self, request):
+        try:
+            size = int(request.query_params.get('page_size', self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def _link(self, row, backwards):
+        if row is None:
+            return None
+        payload = {
+            'v': getattr(row, self.ordering_field).isoformat(),
+            'i': row.pk,
+            'b': backwards,
+        }
+        token = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, token)
+
+    def _decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(token.encode()))
+            return {
+                'value': datetime.fromisoformat(payload['v']),
+                'id': int(payload['i']),
+                'backwards': bool(payload['b']),
+            }
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class SubscriptionHistoryPagination(HistoryPagination):
+    ordering_field = 'start_date'
@@ -0,0 +1,146 @@
+import math
+import re
+from collections import namedtuple
+from string import Template
+from django.conf import settings
+
+try:
+    import tiktoken
+except ImportError:  # optional; fall back to an estimate
+    tiktoken = None
+
+# Prompts are assembled from templates compiled once per subject family and
+# grade band. The question is compacted and, past PROMPT_MAX_QUESTION_TOKENS,
+# truncated; its predicted difficulty picks the answer budget and model tier.
+Prompt = namedtuple('Prompt', ['text', 'difficulty', 'max_tokens', 'tier', 'prompt_tokens'])
+
+SUBJECT_FAMILIES = {
+    'math': ('math', 'algebra', 'geometry', 'arithmetic', 'calculus', 'statistics'),
+    'science': ('science', 'physics', 'chemistry', 'biology'),
+    'language': ('english', 'kiswahili', 'swahili', 'language', 'reading', 'writing', 'literature', 'french'),
+}
+
+FAMILY_GUIDANCE = {
+    'math': 'Show the working as numbered steps and check the final answer.',
+    'science': 'Explain the idea behind the answer with an everyday example.',
+    'language': 'Point to the rule or pattern involved and give one more example.',
+    'general': 'Explain the key idea, then the answer.',
+}
+
+BAND_GUIDANCE = {
+    'lower': 'Use very short sentences and words a young child knows.',
+    'middle': 'Use plain language and define any new term.',
+    'upper': 'Be concise; correct terminology is fine.',
+}
+
+# 'json' answers are parsed into fields; 'text' reads well as it streams
+ANSWER_FORMATS = {
+    'json': (
+        'Reply with only a JSON object with the keys "summary" (one sentence), '
+        '"explanation" (parent-friendly, without the steps), "steps" (list of short strings), '
+        '"difficulty" ("easy", "medium" or "hard") and "tip" (one tip for the parent).'
+    ),
+    'text': (
+        'Give a parent-friendly explanation, then numbered steps, '
+        'then "Difficulty: easy/medium/hard" and one tip for the parent.'
+    ),
+}
+
+BASE_TEMPLATE = (
+    "You help parents explain homework to their child ($subject, $grade).\n"
+    "$family_guidance $band_guidance\n"
+    "$answer_format\n\n"
+    "Question: $question"
+)
+
+TEMPLATES = {
+    (family, band, answer_format): Template(
+        Template(BASE_TEMPLATE).safe_substitute(
+            family_guidance=FAMILY_GUIDANCE[family],
+            band_guidance=BAND_GUIDANCE[band],
+            answer_format=ANSWER_FORMATS[answer_format]
+        )
+    )
+    for family in FAMILY_GUIDANCE
+    for band in BAND_GUIDANCE
+    for answer_format in ANSWER_FORMATS
+}
+
+WHITESPACE_RE = re.compile(r'[ \t]+')
+BLANK_LINES_RE = re.compile(r'\n\s*\n+')
+NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+MULTI_STEP_RE = re.compile(r'\b(prove|explain why|show that|calculate|solve|simplify|compare)\b', re.IGNORECASE)
+GRADE_RE = re.compile(r'\d+')
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Token count with tiktoken when installed, otherwise a close estimate"""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        return len(_encoding.encode(text))
+    return math.ceil(max(len(text) / 4, len(text.split()) * 1.3))
+
+
+def build_prompt(content, subject, grade_level, answer_format='json'):
+    question = compact(content)
+    question_tokens = count_tokens(question)
+    if question_tokens > settings.PROMPT_MAX_QUESTION_TOKENS:
+        question = truncate(question, question_tokens, settings.PROMPT_MAX_QUESTION_TOKENS)
+        question_tokens = count_tokens(question)
+
+    band = grade_band(grade_level)
+    text = TEMPLATES[(subject_family(subject), band, answer_format)].substitute(
+        subject=subject, grade=grade_level, question=question
+    )
+    difficulty = predict_difficulty(question, question_tokens, band)
+    budget = settings.PROMPT_BUDGETS[difficulty]
+    return Prompt(text, difficulty, budget['max_tokens'], budget['tier'], count_tokens(text))
+
+
+def compact(content):
+    content = WHITESPACE_RE.sub(' ', content or '')
+    return BLANK_LINES_RE.sub('\n', content).strip()
+
+
+def truncate(question, tokens, limit):
+    # Keep the start (context) and the end (usually the actual ask)
+    keep = int(len(question) * limit / tokens)
+    head, tail = keep * 2 // 3, keep // 3
+    return f"{question[:head].rstrip()}\n[...]\n{question[-tail:].lstrip()}"
+
+
+def subject_family(subject):
+    subject = (subject or '').lower()
+    for family, keywords in SUBJECT_FAMILIES.items():
+        if any(keyword in subject for keyword in keywords):
+            return family
+    return 'general'
+
+
+def grade_band(grade_level):
+    match = GRADE_RE.search(grade_level or '')
+    grade = int(match.group()) if match else 5
+    if grade <= 3:
+        return 'lower'
+    if grade <= 7:
+        return 'middle'
+    return 'upper'
+
+
+def predict_difficulty(question, question_tokens, band):
+    score = 0
+    if question_tokens > 150:
+        score += 1
+    if question_tokens > 400:
+        score += 1
+    if band == 'upper':
+        score += 1
+    if len(NUMBER_RE.findall(question)) >= 4 or MULTI_STEP_RE.search(question):
+        score += 1
+    if score == 0:
+        return 'easy'
+    return 'medium' if score <= 2 else 'hard'
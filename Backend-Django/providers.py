@@ -0,0 +1,343 @@
+import json
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .clients import get_http_session
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+# Token counts are None when a backend doesn't report usage
+Completion = namedtuple('Completion', ['text', 'prompt_tokens', 'completion_tokens'])
+
+
+class OpenAIProvider:
+    name = 'openai'
+
+    def __init__(self):
+        self.api_key = settings.OPENAI_API_KEY
+        self.api_base = settings.OPENAI_API_BASE.rstrip('/')
+        self.models = settings.OPENAI_MODELS
+
+    def complete(self, prompt, max_tokens=500, temperature=0.7, tier='fast'):
+        body = self._post(prompt, max_tokens, temperature, tier).json()
+        usage = body.get('usage', {})
+        return Completion(
+            body['choices'][0]['message']['content'],
+            usage.get('prompt_tokens'),
+            usage.get('completion_tokens')
+        )
+
+    def stream(self, prompt, max_tokens=500, temperature=0.7, tier='fast'):
+        """Yield the completion text piece by piece as the model produces it"""
+        with self._post(prompt, max_tokens, temperature, tier, stream=True) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data: '):
+                    continue
+                data = line[len('data: '):]
+                if data == '[DONE]':
+                    break
+                text = json.loads(data)['choices'][0]['delta'].get('content')
+                if text:
+                    yield text
+
+    def _post(self, prompt, max_tokens, temperature, tier, stream=False):
+        payload = {
+            'model': self.models[tier],
+            'messages': [{"role": "user", "content": prompt}],
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+        }
+        if stream:
+            payload['stream'] = True
+        response = get_http_session(self.name).post(
+            f"{self.api_base}/chat/completions",
+            json=payload,
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            stream=stream
+        )
+        response.raise_for_status()
+        return response
+
+
+class ClaudeProvider:
+    name = 'claude'
+
+    def __init__(self):
+        self.api_key = settings.CLAUDE_API_KEY
+        self.api_base = settings.CLAUDE_API_BASE.rstrip('/')
+        self.models = settings.CLAUDE_MODELS
+
+    def complete(self, prompt, max_tokens=500, temperature=0.7, tier='fast'):
+        body = self._post(prompt, max_tokens, temperature, tier).json()
+        usage = body.get('usage', {})
+        return Completion(
+            ''.join(block.get('text', '') for block in body['content']),
+            usage.get('input_tokens'),
+            usage.get('output_tokens')
+        )
+
+    def stream(self, prompt, max_tokens=500, temperature=0.7, tier='fast'):
+        """Yield the completion text piece by piece as the model produces it"""
+        with self._post(prompt, max_tokens, temperature, tier, stream=True) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data: '):
+                    continue
+                event = json.loads(line[len('data: '):])
+                if event.get('type') == 'message_stop':
+                    break
+                if event.get('type') == 'content_block_delta':
+                    text = event['delta'].get('text')
+                    if text:
+                        yield text
+
+    def _post(self, prompt, max_tokens, temperature, tier, stream=False):
+        payload = {
+            'model': self.models[tier],
+            'messages': [{"role": "user", "content": prompt}],
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+        }
+        if stream:
+            payload['stream'] = True
+        response = get_http_session(self.name).post(
+            f"{self.api_base}/v1/messages",
+            json=payload,
+            headers={
+                "x-api-key": self.api_key,
+                "anthropic-version": settings.CLAUDE_API_VERSION,
+            },
+            stream=stream
+        )
+        response.raise_for_status()
+        return response
+
+
+class StubProvider:
+    """Offline provider for local development and tests"""
+    name = 'stub'
+    model = 'stub'
+
+    def complete(self, prompt, max_tokens=500, temperature=0.7, tier='fast'):
+        return Completion(self._answer(prompt), None, None)
+
+    def stream(self, prompt, max_tokens=500, temperature=0.7, tier='fast'):
+        delay = settings.AI_STUB_TOKEN_DELAY
+        words = self._answer(prompt).split(' ')
+        for index, word in enumerate(words):
+            if delay:
+                time.sleep(delay)
+            yield word if index == len(words) - 1 else word + ' '
+
+    def _answer(self, prompt):
+        steps = [
+            "Read the question carefully with your child.",
+            "Break it into smaller parts and solve each one.",
+            "Check the answer by working backwards.",
+        ]
+        if 'JSON' in prompt:
+            return json.dumps({
+                'summary': "Let's work through this together.",
+                'explanation': "Let's work through this together, one small part at a time.",
+                'steps': steps,
+                'difficulty': 'easy',
+                'tip': "Let your child explain each step back to you.",
+            })
+        numbered = "\n".join(f"{index}. {step}" for index, step in enumerate(steps, 1))
+        return f"Let's work through this together.\n{numbered}\nDifficulty: easy"
+
+
+class ProviderUnavailable(Exception):
+    """No AI backend could answer: all failed or their circuit breakers are open"""
+
+
+class BackendStats:
+    """Rolling latency and error record for one backend, plus its circuit breaker.
+
+    The breaker opens after AI_ROUTER_BREAKER_FAILURES consecutive failures.
+    After AI_ROUTER_BREAKER_COOLDOWN seconds it lets a single probe through;
+    a success closes it, a failure restarts the cooldown.
+    """
+
+    def __init__(self):
+        self.results = deque(maxlen=settings.AI_ROUTER_WINDOW)  # (seconds, succeeded)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        self.lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.results.append((latency, ok))
+            self.probe_started = None
+            if ok:
+                self.consecutive_failures = 0
+                self.opened_at = None
+                return
+            self.consecutive_failures += 1
+            if self.opened_at is not None or self.consecutive_failures >= settings.AI_ROUTER_BREAKER_FAILURES:
+                self.opened_at = time.monotonic()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            cooldown = settings.AI_ROUTER_BREAKER_COOLDOWN
+            if now - self.opened_at < cooldown:
+                return False
+            # Half open: one probe at a time (a lost probe expires after a cooldown)
+            if self.probe_started is not None and now - self.probe_started < cooldown:
+                return False
+            self.probe_started = now
+            return True
+
+    def latency(self, quantile):
+        with self.lock:
+            latencies = sorted(latency for latency, ok in self.results if ok)
+        if len(latencies) < settings.AI_ROUTER_MIN_SAMPLES:
+            return None
+        return latencies[min(int(len(latencies) * quantile), len(latencies) - 1)]
+
+    def error_rate(self):
+        with self.lock:
+            if not self.results:
+                return 0.0
+            return sum(1 for _, ok in self.results if not ok) / len(self.results)
+
+    def snapshot(self):
+        if self.opened_at is None:
+            state = 'closed'
+        elif time.monotonic() - self.opened_at < settings.AI_ROUTER_BREAKER_COOLDOWN:
+            state = 'open'
+        else:
+            state = 'half-open'
+        p50, p95 = self.latency(0.5), self.latency(0.95)
+        return {
+            'state': state,
+            'requests': len(self.results),
+            'error_rate': round(self.error_rate(), 4),
+            'p50_ms': round(p50 * 1000) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000) if p95 is not None else None,
+        }
+
+
+class RouterProvider:
+    """Sends each request to the fastest healthy backend in AI_ROUTER_BACKENDS.
+
+    If the answer hasn't arrived by the backend's p95 latency, a hedged copy
+    goes to the next backend and the first good answer wins. Failed backends
+    are skipped at once and tripped out by their circuit breakers.
+    """
+    name = 'router'
+
+    def __init__(self):
+        # Own instances, so each backend reads its settings when the router is built
+        self.backends = {
+            name: import_string(settings.AI_PROVIDERS[name])() for name in settings.AI_ROUTER_BACKENDS
+        }
+        self.stats = {name: BackendStats() for name in self.backends}
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+
+    def complete(self, prompt, max_tokens=500, temperature=0.7, tier='fast'):
+        candidates = iter(self._candidates())
+        errors = []
+        pending = set()
+        request = (prompt, max_tokens, temperature, tier)
+        deadline = self._launch(candidates, pending, request)
+
+        while pending:
+            done, pending = wait(pending, timeout=deadline, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as exc:
+                    errors.append(exc)
+            # Too slow or failed: hedge / fail over to the next backend
+            deadline = self._launch(candidates, pending, request)
+
+        raise ProviderUnavailable(f"All AI providers failed: {errors}")
+
+    def stream(self, prompt, max_tokens=500, temperature=0.7, tier='fast'):
+        """Stream from the best backend, failing over until the first token arrives"""
+        errors = []
+        for name in self._candidates():
+            if not self.stats[name].allow():
+                continue
+            start = time.monotonic()
+            tokens = self.backends[name].stream(prompt, max_tokens=max_tokens, temperature=temperature, tier=tier)
+            try:
+                first = next(tokens, '')
+            except Exception as exc:
+                self.stats[name].record(time.monotonic() - start, False)
+                errors.append(exc)
+                continue
+
+            self.stats[name].record(time.monotonic() - start, True)
+            if first:
+                yield first
+            yield from tokens
+            return
+        raise ProviderUnavailable(f"All AI providers failed: {errors}")
+
+    def describe(self):
+        return {name: stats.snapshot() for name, stats in self.stats.items()}
+
+    def _candidates(self):
+        # Healthy backends first, then by recent median latency (unmeasured ones first).
+        # Breakers are asked only when a backend is about to be called, so a
+        # half-open backend's probe isn't spent on a request it never sees.
+        def rank(name):
+            stats = self.stats[name]
+            return (stats.error_rate() > 0.5, stats.latency(0.5) or 0.0)
+        return sorted(self.backends, key=rank)
+
+    def _launch(self, candidates, pending, request):
+        """Start a request on the next backend its breaker lets through.
+
+        Returns how long to wait before hedging, or None if no backend is left.
+        """
+        for name in candidates:
+            if self.stats[name].allow():
+                pending.add(self._get_executor().submit(self._call, name, *request))
+                return self.stats[name].latency(0.95) or settings.AI_ROUTER_HEDGE_DELAY
+        return None
+
+    def _call(self, name, prompt, max_tokens, temperature, tier):
+        start = time.monotonic()
+        try:
+            result = self.backends[name].complete(prompt, max_tokens=max_tokens, temperature=temperature, tier=tier)
+        except Exception:
+            self.stats[name].record(time.monotonic() - start, False)
+            raise
+        self.stats[name].record(time.monotonic() - start, True)
+        return result
+
+    def _get_executor(self):
+        # Threads don't survive a fork; build a new pool in each worker process
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.AI_ROUTER_MAX_WORKERS,
+                    thread_name_prefix='ai-router'
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+
+def get_provider(name=None):
+    """Return the shared provider instance; providers hold no per-request state"""
+    name = name or settings.AI_PROVIDER
+    provider = _providers.get(name)
+    if provider is None:
+        with _providers_lock:
+            provider = _providers.get(name)
+            if provider is None:
+                provider = _providers[name] = import_string(settings.AI_PROVIDERS[name])()
+    return provider
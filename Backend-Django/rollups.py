@@ -0,0 +1,91 @@
+from datetime import date, datetime, time, timedelta
+from django.db import transaction
+from django.db.models import Count, DecimalField, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .clients import get_redis
+from .models import Question, DailyUsageRollup
+
+# Question writes mark their (local) day dirty; refresh_rollups() rebuilds only
+# the dirty days, each with one indexed range scan over that day's questions.
+DIRTY_DAYS_KEY = 'rollups:dirty_days'
+
+RATINGS = range(1, 6)
+
+
+def mark_dirty(moment):
+    get_redis().sadd(DIRTY_DAYS_KEY, timezone.localdate(moment).isoformat())
+
+
+def refresh_rollups():
+    """Rebuild the rollups of every dirty day. Returns the days rebuilt."""
+    redis_client = get_redis()
+    days = sorted(redis_client.smembers(DIRTY_DAYS_KEY))
+    for day in days:
+        # Clear the mark first so writes during the rebuild mark the day again
+        redis_client.srem(DIRTY_DAYS_KEY, day)
+        try:
+            rebuild_day(date.fromisoformat(day))
+        except Exception:
+            # Leave the day for the next run
+            redis_client.sadd(DIRTY_DAYS_KEY, day)
+            raise
+    return days
+
+
+def rebuild_day(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+    rating_counts = {
+        f'rating_{rating}': Count('id', filter=Q(rating=rating)) for rating in RATINGS
+    }
+
+    rows = (
+        Question.objects.filter(created_at__gte=start, created_at__lt=end)
+        .values('subject', 'grade_level', 'plan')
+        .annotate(
+            questions=Count('id'),
+            unique_users=Count('user', distinct=True),
+            revenue=Coalesce(Sum('cost'), 0, output_field=DecimalField(max_digits=12, decimal_places=2)),
+            processed_questions=Count('processing_time'),
+            processing_time_total=Coalesce(Sum('processing_time'), 0),
+            **rating_counts
+        )
+        .order_by()
+    )
+
+    rollups = [
+        DailyUsageRollup(
+            day=day,
+            subject=row['subject'],
+            grade_level=row['grade_level'],
+            plan=row['plan'],
+            questions=row['questions'],
+            unique_users=row['unique_users'],
+            revenue=row['revenue'],
+            processed_questions=row['processed_questions'],
+            processing_time_total=row['processing_time_total'],
+            rating_counts={str(rating): row[f'rating_{rating}'] for rating in RATINGS},
+        )
+        for row in rows
+    ]
+
+    with transaction.atomic():
+        DailyUsageRollup.objects.filter(day=day).delete()
+        DailyUsageRollup.objects.bulk_create(rollups)
+    return len(rollups)
+
+
+def usage_summary(start, end):
+    """Totals per day between two dates (inclusive), read from the rollups"""
+    return list(
+        DailyUsageRollup.objects.filter(day__gte=start, day__lte=end)
+        .values('day')
+        .annotate(
+            questions=Sum('questions'),
+            revenue=Sum('revenue'),
+            processed_questions=Sum('processed_questions'),
+            processing_time_total=Sum('processing_time_total'),
+        )
+        .order_by('day')
+    )
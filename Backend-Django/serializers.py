@@ -1,5 +1,9 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.db import transaction
+from django.urls import reverse
+from . import blobs, credits
 from .models import User, Child, Question, Payment, Subscription
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
@@ -46,6 +50,7 @@ class ChildSerializer(serializers.ModelSerializer):
 
 class UserProfileSerializer(serializers.ModelSerializer):
     children = ChildSerializer(many=True, read_only=True)
+    credits = serializers.SerializerMethodField()
     
     class Meta:
         model = User
@@ -55,22 +60,134 @@ class UserProfileSerializer(serializers.ModelSerializer):
             'credits', 'total_spent', 'children', 'created_at', 'last_login'
         ]
         read_only_fields = ['subscription_type', 'subscription_status', 'credits', 'total_spent']
+    
+    def get_credits(self, obj):
+        return credits.get_balance(obj.pk)
+    
+    def update(self, instance, validated_data):
+        # Only write the edited columns; credits and totals are updated elsewhere
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=list(validated_data))
+        return instance
+
+class SparseFieldsetsMixin:
+    """`?fields=a,b` trims a GET response to those fields; `?expand=x,y` adds expandable ones"""
+    expandable_fields = ()
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+        
+        expand = query_param_set(request, 'expand')
+        for name in self.expandable_fields:
+            if name not in expand:
+                self.fields.pop(name, None)
+        
+        fields = query_param_set(request, 'fields')
+        if fields:
+            for name in list(self.fields):
+                if name not in fields:
+                    self.fields.pop(name)
 
-class QuestionSerializer(serializers.ModelSerializer):
+def query_param_set(request, name):
+    return {value.strip() for value in request.query_params.get(name, '').split(',') if value.strip()}
+
+class QuestionImageMixin:
+    """Points `image` and `thumbnails` at the ownership-checked image endpoints"""
+    
+    def get_thumbnails(self, obj):
+        blob = obj.image_blob
+        if blob is None:
+            return {}
+        return {size: self._image_url(obj, size) for size in blob.thumbnails}
+    
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if data.get('image'):
+            data['image'] = self._image_url(instance)
+        return data
+    
+    def _image_url(self, question, size=None):
+        kwargs = {'pk': question.pk}
+        if size:
+            kwargs['size'] = size
+        url = reverse('question-image', kwargs=kwargs)
+        # The digest makes the URL change whenever the image does
+        if question.image_blob_id:
+            url = f"{url}?v={question.image_blob.digest[:16]}"
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+class QuestionListSerializer(QuestionImageMixin, SparseFieldsetsMixin, serializers.ModelSerializer):
+    """Compact question for lists; the answer body is opt-in via ?expand="""
     child_name = serializers.CharField(source='child.name', read_only=True)
+    thumbnails = serializers.SerializerMethodField()
+    expandable_fields = (
+        'ai_response', 'explanation', 'step_by_step', 'processing_time',
+        'prompt_tokens', 'completion_tokens', 'feedback'
+    )
     
     class Meta:
         model = Question
         fields = [
-            'id', 'question_id', 'type', 'content', 'image', 'subject',
+            'id', 'question_id', 'type', 'content', 'image', 'thumbnails', 'subject',
+            'grade_level', 'child', 'child_name', 'difficulty', 'rating',
+            'cost', 'is_processed', 'status', 'created_at',
+            'ai_response', 'explanation', 'step_by_step', 'processing_time',
+            'prompt_tokens', 'completion_tokens', 'feedback'
+        ]
+        read_only_fields = fields
+
+class QuestionSerializer(QuestionImageMixin, SparseFieldsetsMixin, serializers.ModelSerializer):
+    child_name = serializers.CharField(source='child.name', read_only=True)
+    thumbnails = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = Question
+        fields = [
+            'id', 'question_id', 'type', 'content', 'image', 'thumbnails', 'subject',
             'grade_level', 'child', 'child_name', 'ai_response', 'explanation',
-            'step_by_step', 'difficulty', 'processing_time', 'rating',
-            'feedback', 'cost', 'is_processed', 'created_at', 'updated_at'
+            'step_by_step', 'difficulty', 'processing_time', 'prompt_tokens',
+            'completion_tokens', 'rating', 'feedback', 'cost', 'is_processed',
+            'status', 'created_at', 'updated_at'
         ]
         read_only_fields = [
             'question_id', 'ai_response', 'explanation', 'step_by_step',
-            'difficulty', 'processing_time', 'cost', 'is_processed'
+            'difficulty', 'processing_time', 'prompt_tokens', 'completion_tokens',
+            'cost', 'is_processed', 'status'
         ]
+    
+    def validate_image(self, value):
+        if value and value.size > settings.IMAGE_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(
+                f"Images must be at most {settings.IMAGE_UPLOAD_MAX_SIZE // (1024 * 1024)} MB"
+            )
+        return value
+    
+    def create(self, validated_data):
+        self._store_image(validated_data)
+        return super().create(validated_data)
+    
+    def update(self, instance, validated_data):
+        previous_blob_id = instance.image_blob_id
+        self._store_image(validated_data)
+        instance = super().update(instance, validated_data)
+        if previous_blob_id and instance.image_blob_id != previous_blob_id:
+            transaction.on_commit(lambda: blobs.release(previous_blob_id))
+        return instance
+    
+    def _store_image(self, validated_data):
+        # Identical uploads share one stored file; the digest was taken while streaming
+        image = validated_data.pop('image', None)
+        if image is None:
+            return
+        digests = getattr(self.context['request'], 'upload_digests', {})
+        blob = blobs.store(image, digests.get('image'))
+        validated_data['image_blob'] = blob
+        validated_data['image'] = blob.file.name
 
 class PaymentSerializer(serializers.ModelSerializer):
     class Meta:
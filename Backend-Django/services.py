@@ -1,104 +1,252 @@
-import openai
+import logging
+import threading
 import requests
 from django.conf import settings
+from django.core.cache import cache
 import base64
 import json
 import time
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from . import answers, credits, entitlements, imaging, notifications, prompts
+from .answer_cache import AnswerCache
+from .clients import get_http_session, get_redis
+from .conditional import invalidate_profiles
+from .models import User, Question, Payment, CreditTransaction
+from .providers import ProviderUnavailable, get_provider
+
+logger = logging.getLogger(__name__)
+
+_mpesa_token_lock = threading.Lock()
+
+class MpesaTransientError(Exception):
+    """Daraja could not be reached or was briefly unavailable; safe to retry"""
 
 class AIService:
     def __init__(self):
-        self.openai_api_key = settings.OPENAI_API_KEY
-        self.claude_api_key = settings.CLAUDE_API_KEY
+        self.provider = get_provider()
     
-    def process_question(self, question):
+    def process_question(self, question, use_cache=True):
+        # Only one worker (background task or streaming request) answers a question
+        if not self._claim(question):
+            return
+        
         try:
             start_time = time.time()
             
             if question.type == 'text':
-                response = self._process_text_question(question.content, question.subject, question.grade_level)
+                response = self._answer_text_question(question, use_cache)
             else:
-                response = self._process_image_question(question.image, question.content, question.subject, question.grade_level)
-            
-            processing_time = int((time.time() - start_time) * 1000)
+                response = self._answer_image_question(question, use_cache)
             
-            question.ai_response = response.get('explanation', '')
-            question.explanation = response.get('simple_explanation', '')
-            question.step_by_step = response.get('steps', [])
-            question.difficulty = response.get('difficulty', 'medium')
-            question.processing_time = processing_time
-            question.is_processed = True
-            question.save()
+            self._save_answer(question, response, int((time.time() - start_time) * 1000))
             
         except Exception as e:
             question.ai_response = f"Sorry, I encountered an error processing your question: {str(e)}"
             question.is_processed = True
-            question.save()
+            question.status = 'done'
+            with transaction.atomic():
+                question.save()
+                notifications.question_answered(question)
+    
+    def stream_question(self, question, use_cache=True):
+        """Answer a text question, yielding (event, data) pairs as tokens arrive"""
+        if question.status == 'done':
+            yield 'done', self._response_payload(question)
+            return
+        if question.type != 'text' or not self._claim(question):
+            yield 'status', {'status': question.status}
+            return
+        
+        start_time = time.time()
+        answer_cache = AnswerCache()
+        cached = answer_cache.get(question.content, question.subject, question.grade_level) if use_cache else None
+        if cached is not None:
+            yield 'token', {'text': cached.get('explanation', '')}
+            self._save_answer(question, self._from_cache(cached), int((time.time() - start_time) * 1000))
+            yield 'done', self._response_payload(question)
+            return
+        
+        # Plain text streams readably; the parser still pulls out steps and difficulty
+        prompt = prompts.build_prompt(question.content, question.subject, question.grade_level, answer_format='text')
+        parts = []
+        last_flush = time.time()
+        try:
+            for text in self.provider.stream(prompt.text, max_tokens=prompt.max_tokens, temperature=0.7, tier=prompt.tier):
+                parts.append(text)
+                yield 'token', {'text': text}
+                
+                # Save partial text now and then so pollers see progress
+                if time.time() - last_flush >= settings.AI_STREAM_FLUSH_INTERVAL:
+                    Question.objects.filter(pk=question.pk).update(ai_response=''.join(parts), updated_at=timezone.now())
+                    last_flush = time.time()
+            
+            # Streams don't report usage; count locally
+            answer = ''.join(parts)
+            response = self._completed_response(prompt, answer, None, prompts.count_tokens(answer))
+            answer_cache.set(question.content, question.subject, question.grade_level, response)
+        except GeneratorExit:
+            # Client went away: hand the question back to the background worker
+            from .tasks import process_question_async
+            Question.objects.filter(pk=question.pk, status='processing').update(status='queued', updated_at=timezone.now())
+            process_question_async.delay(question.id, use_cache=use_cache)
+            raise
+        except Exception:
+            response = self._failed_response()
+        
+        self._save_answer(question, response, int((time.time() - start_time) * 1000))
+        yield 'done', self._response_payload(question)
+    
+    def _claim(self, question):
+        claimed = Question.objects.filter(pk=question.pk, status='queued').update(
+            status='processing', updated_at=timezone.now()
+        )
+        if claimed:
+            # Let status pollers know the question has been picked up
+            question.status = 'processing'
+        return bool(claimed)
+    
+    def _save_answer(self, question, response, processing_time):
+        # The notification commits with the answer; a dispatcher sends it later
+        with transaction.atomic():
+            self._apply_response(question, response, processing_time)
+            notifications.question_answered(question)
+    
+    def _apply_response(self, question, response, processing_time):
+        question.ai_response = response.get('explanation', '')
+        question.explanation = response.get('simple_explanation', '')
+        question.step_by_step = response.get('steps', [])
+        question.difficulty = response.get('difficulty', 'medium')
+        question.processing_time = processing_time
+        question.prompt_tokens = response.get('prompt_tokens')
+        question.completion_tokens = response.get('completion_tokens')
+        question.is_processed = True
+        question.status = 'done'
+        question.save()
+    
+    def _response_payload(self, question):
+        return {
+            'question_id': question.question_id,
+            'ai_response': question.ai_response,
+            'explanation': question.explanation,
+            'step_by_step': question.step_by_step,
+            'difficulty': question.difficulty,
+            'processing_time': question.processing_time,
+        }
+    
+    def _answer_text_question(self, question, use_cache):
+        answer_cache = AnswerCache()
+        if use_cache:
+            cached = answer_cache.get(question.content, question.subject, question.grade_level)
+            if cached is not None:
+                return self._from_cache(cached)
+        
+        response = self._process_text_question(question.content, question.subject, question.grade_level)
+        if not response.get('failed'):
+            answer_cache.set(question.content, question.subject, question.grade_level, response)
+        return response
     
     def _process_text_question(self, content, subject, grade_level):
-        prompt = f"""
-        You are a friendly homework helper for parents. A parent needs help explaining this {subject} question to their child in grade {grade_level}.
-
-        Question: {content}
-
-        Please provide:
-        1. A simple, parent-friendly explanation
-        2. Step-by-step solution if applicable
-        3. Difficulty level (easy/medium/hard)
-        4. Tips for the parent to help their child understand
-
-        Keep the language simple and encouraging.
-        """
+        prompt = prompts.build_prompt(content, subject, grade_level)
         
         try:
-            openai.api_key = self.openai_api_key
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=500,
-                temperature=0.7
+            completion = self.provider.complete(
+                prompt.text, max_tokens=prompt.max_tokens, temperature=0.7, tier=prompt.tier
             )
-            
-            content = response.choices[0].message.content
-            
-            # Parse response (simplified)
-            return {
-                'explanation': content,
-                'simple_explanation': content[:200] + "...",
-                'steps': [{'step': 1, 'description': content}],
-                'difficulty': 'medium'
-            }
-            
-        except Exception as e:
-            return {
-                'explanation': f"I'm having trouble processing this question right now. Please try again later.",
-                'simple_explanation': "Technical difficulty occurred.",
-                'steps': [],
-                'difficulty': 'medium'
-            }
+        except (ProviderUnavailable, requests.RequestException, KeyError, ValueError):
+            # The router has already tried every healthy backend
+            return self._failed_response()
+        
+        completion_tokens = completion.completion_tokens
+        if completion_tokens is None:
+            completion_tokens = prompts.count_tokens(completion.text)
+        return self._completed_response(prompt, completion.text, completion.prompt_tokens, completion_tokens)
     
-    def _process_image_question(self, image_file, additional_context, subject, grade_level):
-        # For image processing, you would typically use OCR first, then process the text
-        # This is a simplified implementation
+    def _completed_response(self, prompt, answer, prompt_tokens, completion_tokens):
+        response = answers.parse_answer(answer, default_difficulty=prompt.difficulty)
+        response['prompt_tokens'] = prompt_tokens if prompt_tokens is not None else prompt.prompt_tokens
+        response['completion_tokens'] = completion_tokens
+        return response
+    
+    def _from_cache(self, cached):
+        # A cached answer cost no tokens this time
+        return {**cached, 'prompt_tokens': 0, 'completion_tokens': 0}
+    
+    def _failed_response(self):
         return {
-            'explanation': "Image processing is not fully implemented in this demo. Please convert the image to text and ask again.",
-            'simple_explanation': "Please describe the problem in text form.",
+            'explanation': f"I'm having trouble processing this question right now. Please try again later.",
+            'simple_explanation': "Technical difficulty occurred.",
             'steps': [],
-            'difficulty': 'medium'
+            'difficulty': 'medium',
+            'failed': True
         }
+    
+    def _answer_image_question(self, question, use_cache):
+        # A page we have already answered skips preprocessing, OCR and the model call
+        digest = question.image_blob.digest if question.image_blob_id else None
+        answer_cache = AnswerCache()
+        if use_cache and digest:
+            cached = answer_cache.get(question.content, question.subject, question.grade_level, image_digest=digest)
+            if cached is not None:
+                return self._from_cache(cached)
+        
+        response = self._process_image_question(question.image, question.content, question.subject, question.grade_level)
+        if digest and not response.get('failed'):
+            answer_cache.set(question.content, question.subject, question.grade_level, response, image_digest=digest)
+        return response
+    
+    def _process_image_question(self, image_file, additional_context, subject, grade_level):
+        # Shrink the photo, read the text off it, then answer it like a text question
+        image_bytes = imaging.prepare_image(image_file)
+        text = imaging.get_text_extractor().extract(image_bytes).strip()
+        if not text:
+            return {
+                'explanation': "I couldn't read any text in this image. Please try a clearer photo or type the question.",
+                'simple_explanation': "The image could not be read.",
+                'steps': [],
+                'difficulty': 'medium',
+                'failed': True
+            }
+        
+        content = f"{text}\n\n{additional_context}" if additional_context else text
+        return self._process_text_question(content, subject, grade_level)
 
 class PaymentService:
+    TOKEN_CACHE_KEY = 'mpesa:access_token'
+    TOKEN_LOCK_KEY = 'mpesa:access_token:lock'
+    CALLBACK_QUEUE_KEY = 'mpesa:callbacks'
+    CALLBACK_LOCK_KEY = 'mpesa:callbacks:lock'
+    CALLBACK_FAILED_KEY = 'mpesa:callbacks:failed'
+    CALLBACK_SEEN_TTL = 60 * 60 * 24 * 3  # Safaricom stops retrying well before this
+    
+    # Mark the callback seen and queue it in one step
+    ENQUEUE_ONCE_SCRIPT = """
+    if redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[2]) then
+        redis.call('RPUSH', KEYS[2], ARGV[1])
+        return 1
+    end
+    return 0
+    """
+    
     def __init__(self):
         self.mpesa_consumer_key = settings.MPESA_CONSUMER_KEY
         self.mpesa_consumer_secret = settings.MPESA_CONSUMER_SECRET
         self.mpesa_shortcode = settings.MPESA_SHORTCODE
         self.mpesa_passkey = settings.MPESA_PASSKEY
+        self.mpesa_base_url = settings.MPESA_BASE_URL.rstrip('/')
     
     def process_mpesa_payment(self, payment):
-        """Process M-Pesa STK Push payment"""
+        """Process M-Pesa STK Push payment.
+        
+        Returns True once Safaricom accepts the push. Payments Safaricom rejects
+        are marked failed; timeouts, connection errors, 429s and 5xx responses
+        raise MpesaTransientError and leave the payment pending for a retry.
+        """
         try:
-            # Get access token
-            access_token = self._get_mpesa_access_token()
-            
             # Generate timestamp
             timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
             
@@ -117,44 +265,260 @@ class PaymentService:
                 "PartyA": payment.user.phone,
                 "PartyB": self.mpesa_shortcode,
                 "PhoneNumber": payment.user.phone,
-                "CallBackURL": "https://yourdomain.com/api/mpesa/callback/",
+                "CallBackURL": settings.MPESA_CALLBACK_URL,
                 "AccountReference": payment.transaction_id,
                 "TransactionDesc": payment.description or "Homework Helper Payment"
             }
             
-            response = requests.post(
-                "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest",
-                json=stk_push_data,
-                headers={
-                    "Authorization": f"Bearer {access_token}",
-                    "Content-Type": "application/json"
-                }
+            response = self._post_with_token(
+                f"{self.mpesa_base_url}/mpesa/stkpush/v1/processrequest",
+                stk_push_data
             )
             
-            if response.status_code == 200:
-                payment.status = 'pending'
-                payment.save()
-                return True
+        except (requests.Timeout, requests.ConnectionError) as e:
+            raise MpesaTransientError(str(e)) from e
+        except requests.HTTPError as e:
+            if e.response is not None and self._is_transient(e.response.status_code):
+                raise MpesaTransientError(str(e)) from e
+            return self._fail(payment)
+        except Exception as e:
+            return self._fail(payment)
+        
+        if response.status_code == 200:
+            # Callbacks are matched to the payment by CheckoutRequestID
+            payment.checkout_request_id = response.json().get('CheckoutRequestID')
+            payment.save(update_fields=['checkout_request_id'])
+            return True
+        if self._is_transient(response.status_code):
+            raise MpesaTransientError(f"Daraja returned {response.status_code}")
+        return self._fail(payment)
+    
+    def enqueue_callback(self, payload):
+        """Queue an STK push callback for batched processing.
+        
+        Safaricom retries callbacks, so each (CheckoutRequestID, ResultCode)
+        pair is queued once. Returns False for duplicates; raises ValueError
+        for a payload that isn't an STK callback.
+        """
+        item = self._parse_callback(payload)
+        seen_key = f"mpesa:callbacks:seen:{item['checkout_request_id']}:{item['result_code']}"
+        return bool(self._enqueue_once(
+            keys=[seen_key, self.CALLBACK_QUEUE_KEY],
+            args=[json.dumps(item), self.CALLBACK_SEEN_TTL]
+        ))
+    
+    def _parse_callback(self, payload):
+        try:
+            callback = payload['Body']['stkCallback']
+            checkout_request_id = callback['CheckoutRequestID']
+            result_code = int(callback['ResultCode'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Malformed STK callback')
+        if not isinstance(checkout_request_id, str) or not checkout_request_id:
+            raise ValueError('Malformed STK callback')
+        
+        metadata = callback.get('CallbackMetadata') or {}
+        entries = metadata.get('Item') if isinstance(metadata, dict) else None
+        if not isinstance(entries, list):
+            entries = []
+        receipt_number = None
+        for entry in entries:
+            if isinstance(entry, dict) and entry.get('Name') == 'MpesaReceiptNumber':
+                receipt_number = entry.get('Value')
+        if receipt_number is not None and not isinstance(receipt_number, str):
+            receipt_number = str(receipt_number)
+        
+        return {
+            'checkout_request_id': checkout_request_id,
+            'result_code': result_code,
+            'receipt_number': receipt_number,
+            'attempts': 0,
+        }
+    
+    def _enqueue_once(self, keys, args):
+        return get_redis().eval(self.ENQUEUE_ONCE_SCRIPT, len(keys), *keys, *args)
+    
+    def apply_callbacks(self):
+        """Apply a batch of queued callbacks in one transaction. Returns the number applied.
+        
+        A callback that fails to apply is retried with later batches and then
+        moved to CALLBACK_FAILED_KEY, without holding up the callbacks behind it.
+        """
+        redis_client = get_redis()
+        batch_size = settings.MPESA_CALLBACK_BATCH_SIZE
+        
+        # A single consumer at a time keeps batches from fighting over the same rows
+        if not cache.add(self.CALLBACK_LOCK_KEY, 1, timeout=60):
+            return 0
+        try:
+            raw_items = redis_client.lrange(self.CALLBACK_QUEUE_KEY, 0, batch_size - 1)
+            if not raw_items:
+                return 0
+            
+            # Latest result wins for a checkout that was reported more than once
+            items = {}
+            for raw in raw_items:
+                item = json.loads(raw)
+                items[item['checkout_request_id']] = item
+            
+            with transaction.atomic():
+                applied, unknown, failed = self._apply_callback_batch(items)
+            
+            # Callbacks can beat the STK push response that records the checkout id,
+            # so unknown ones get a few more tries before they are dropped. Items
+            # that failed to apply get the same tries, then go to the failed list.
+            retry, dead = [], []
+            for item in unknown:
+                if item['attempts'] + 1 < settings.MPESA_CALLBACK_MAX_ATTEMPTS:
+                    retry.append(json.dumps({**item, 'attempts': item['attempts'] + 1}))
+            for item in failed:
+                item = {**item, 'attempts': item['attempts'] + 1}
+                if item['attempts'] < settings.MPESA_CALLBACK_MAX_ATTEMPTS:
+                    retry.append(json.dumps(item))
+                else:
+                    dead.append(json.dumps(item))
+            pipeline = redis_client.pipeline()
+            pipeline.ltrim(self.CALLBACK_QUEUE_KEY, len(raw_items), -1)
+            if retry:
+                pipeline.rpush(self.CALLBACK_QUEUE_KEY, *retry)
+            if dead:
+                # Kept for inspection; nothing reads this list automatically
+                pipeline.rpush(self.CALLBACK_FAILED_KEY, *dead)
+            pipeline.execute()
+            return applied
+        finally:
+            cache.delete(self.CALLBACK_LOCK_KEY)
+    
+    def _apply_callback_batch(self, items):
+        """Apply items in one savepoint, falling back to one savepoint per item.
+        
+        Returns (applied, unknown items, failed items).
+        """
+        try:
+            with transaction.atomic():
+                applied, unknown = self._apply_callback_items(items)
+            return applied, unknown, []
+        except Exception:
+            logger.exception('M-Pesa callback batch failed; applying items one at a time')
+        
+        applied, unknown, failed = 0, [], []
+        for checkout_request_id, item in items.items():
+            try:
+                with transaction.atomic():
+                    count, missing = self._apply_callback_items({checkout_request_id: item})
+            except Exception:
+                logger.exception('M-Pesa callback for %s failed', checkout_request_id)
+                failed.append(item)
+                continue
+            applied += count
+            unknown += missing
+        return applied, unknown, failed
+    
+    def _apply_callback_items(self, items):
+        payments = list(
+            Payment.objects.select_for_update()
+            .filter(checkout_request_id__in=list(items))
+            .order_by('id')
+        )
+        known = {payment.checkout_request_id for payment in payments}
+        unknown = [item for checkout_id, item in items.items() if checkout_id not in known]
+        
+        changed = []
+        grants = []
+        spent = defaultdict(Decimal)
+        for payment in payments:
+            if payment.status != 'pending':
+                continue  # already applied
+            item = items[payment.checkout_request_id]
+            if item['result_code'] == 0:
+                payment.status = 'completed'
+                payment.mpesa_receipt_number = item['receipt_number']
+                spent[payment.user_id] += payment.amount
+                if payment.type == 'credits':
+                    grants.append(CreditTransaction(
+                        user_id=payment.user_id,
+                        delta=int(payment.amount // settings.PRICE_PER_QUESTION),
+                        reason='purchase',
+                        payment=payment
+                    ))
             else:
                 payment.status = 'failed'
-                payment.save()
-                return False
-                
-        except Exception as e:
-            payment.status = 'failed'
-            payment.save()
-            return False
+            changed.append(payment)
+        
+        Payment.objects.bulk_update(changed, ['status', 'mpesa_receipt_number'])
+        credits.grant(grants)
+        
+        # bulk_update skips the signals that normally refresh entitlements
+        changed_users = {payment.user_id for payment in changed}
+        transaction.on_commit(lambda: entitlements.invalidate(changed_users))
+        transaction.on_commit(lambda: invalidate_profiles(changed_users))
+        
+        # One UPDATE per user, in a fixed order so concurrent writers don't deadlock
+        for user_id in sorted(spent):
+            User.objects.filter(pk=user_id).update(total_spent=F('total_spent') + spent[user_id])
+        return len(changed), unknown
+    
+    def _is_transient(self, status_code):
+        return status_code == 429 or status_code >= 500
+    
+    def _fail(self, payment):
+        payment.status = 'failed'
+        payment.save(update_fields=['status'])
+        return False
+    
+    def _post_with_token(self, url, data):
+        response = get_http_session('mpesa').post(
+            url,
+            json=data,
+            headers={"Authorization": f"Bearer {self._get_mpesa_access_token()}"}
+        )
+        if response.status_code == 401:
+            # Token was revoked early: fetch a fresh one and try once more
+            cache.delete(self.TOKEN_CACHE_KEY)
+            response = get_http_session('mpesa').post(
+                url,
+                json=data,
+                headers={"Authorization": f"Bearer {self._get_mpesa_access_token()}"}
+            )
+        return response
     
     def _get_mpesa_access_token(self):
-        """Get M-Pesa access token"""
-        consumer_key = self.mpesa_consumer_key
-        consumer_secret = self.mpesa_consumer_secret
-        api_url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-        
-        response = requests.get(
-            api_url,
-            auth=(consumer_key, consumer_secret)
+        """Get M-Pesa access token, shared by all workers until shortly before it expires"""
+        access_token = cache.get(self.TOKEN_CACHE_KEY)
+        if access_token:
+            return access_token
+        
+        # Single flight: one thread per process, one process across workers
+        with _mpesa_token_lock:
+            access_token = cache.get(self.TOKEN_CACHE_KEY)
+            if access_token:
+                return access_token
+            
+            lock_timeout = settings.MPESA_TOKEN_LOCK_TIMEOUT
+            deadline = time.time() + lock_timeout
+            locked = cache.add(self.TOKEN_LOCK_KEY, 1, timeout=lock_timeout)
+            while not locked and time.time() < deadline:
+                time.sleep(0.1)
+                access_token = cache.get(self.TOKEN_CACHE_KEY)
+                if access_token:
+                    return access_token
+                locked = cache.add(self.TOKEN_LOCK_KEY, 1, timeout=lock_timeout)
+            
+            try:
+                return cache.get(self.TOKEN_CACHE_KEY) or self._fetch_mpesa_access_token()
+            finally:
+                if locked:
+                    cache.delete(self.TOKEN_LOCK_KEY)
+    
+    def _fetch_mpesa_access_token(self):
+        response = get_http_session('mpesa').get(
+            f"{self.mpesa_base_url}/oauth/v1/generate?grant_type=client_credentials",
+            auth=(self.mpesa_consumer_key, self.mpesa_consumer_secret)
         )
+        response.raise_for_status()
         
-        return response.json()['access_token']
-
+        data = response.json()
+        expires_in = int(data.get('expires_in', 3599))
+        timeout = max(expires_in - settings.MPESA_TOKEN_EXPIRY_MARGIN, 1)
+        cache.set(self.TOKEN_CACHE_KEY, data['access_token'], timeout)
+        return data['access_token']
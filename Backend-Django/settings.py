@@ -65,6 +65,25 @@ DATABASES = {
     }
 }
 
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f'{REDIS_URL}/0',
+    },
+    # Shared AI answer cache. Point this at a Redis database/instance running
+    # with maxmemory-policy allkeys-lru so the oldest answers are evicted first.
+    'answers': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('ANSWER_CACHE_URL', f'{REDIS_URL}/1'),
+        'KEY_PREFIX': 'answers',
+    },
+}
+
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', REDIS_URL)
+CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', REDIS_URL)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -95,7 +114,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'homework_helper.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -118,22 +137,144 @@ CORS_ALLOWED_ORIGINS = [
 ]
 
 # File upload settings
-FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2 * 1024 * 1024  # larger uploads are streamed to a temporary file
+FILE_UPLOAD_HANDLERS = [
+    'homework_helper.blobs.HashingUploadHandler',  # digest for content-addressed image storage
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+IMAGE_UPLOAD_MAX_SIZE = 10 * 1024 * 1024  # 10MB
+IMAGE_BLOB_GRACE_PERIOD = 3600  # seconds an unreferenced image is kept before collection
+IMAGE_THUMBNAIL_SIZES = {'small': 160, 'medium': 480}  # longest side in pixels
+
+# Question images are served by the web server after the ownership check:
+# 'x-accel' (nginx internal location at MEDIA_OFFLOAD_PREFIX), 'x-sendfile' or 'django'
+MEDIA_OFFLOAD = os.environ.get('MEDIA_OFFLOAD', 'django')
+MEDIA_OFFLOAD_PREFIX = '/protected-media/'
+MEDIA_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Pricing
+PRICE_PER_QUESTION = 10  # KES, pay-per-use questions and credit purchases
+CREDIT_LEDGER_COMPACTION_BATCH = 1000  # ledger entries folded into balances per transaction
+SUBSCRIPTION_EXPIRY_BATCH_SIZE = 1000  # subscriptions expired per transaction
+
+# Token authentication cache
+AUTH_TOKEN_CACHE_TTL = 60 * 5  # seconds in Redis
+AUTH_TOKEN_LOCAL_TTL = 10  # seconds in process memory
+AUTH_TOKEN_LOCAL_MAX_ENTRIES = 10000
+AUTH_STATS_FLUSH_EVERY = 100  # lookups counted locally before pushing to Redis
+
+# Activity tracking (last seen and daily active users, kept in Redis)
+ACTIVITY_RECORD_INTERVAL = 60  # seconds between writes for the same user per process
+ACTIVITY_RECENT_MAX_ENTRIES = 50000
+ACTIVITY_RETENTION_DAYS = 90  # daily active-user HyperLogLogs
+ACTIVITY_FLUSH_BATCH_SIZE = 1000
+
+# Entitlement snapshots (plan, quota, expiry, per-question cost)
+ENTITLEMENT_CACHE_TTL = 60 * 10  # seconds in Redis
+ENTITLEMENT_LOCAL_TTL = 5  # seconds in process memory
+ENTITLEMENT_LOCAL_MAX_ENTRIES = 10000
 
 # AI Service Settings
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
 CLAUDE_API_KEY = os.environ.get('CLAUDE_API_KEY', '')
 
+OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')
+CLAUDE_API_BASE = os.environ.get('CLAUDE_API_BASE', 'https://api.anthropic.com')
+CLAUDE_API_VERSION = '2023-06-01'
+
+# Model per tier; prompts pick the tier from the question's predicted difficulty
+OPENAI_MODELS = {
+    'fast': os.environ.get('OPENAI_FAST_MODEL', 'gpt-3.5-turbo'),
+    'strong': os.environ.get('OPENAI_STRONG_MODEL', 'gpt-4o'),
+}
+CLAUDE_MODELS = {
+    'fast': os.environ.get('CLAUDE_FAST_MODEL', 'claude-3-haiku-20240307'),
+    'strong': os.environ.get('CLAUDE_STRONG_MODEL', 'claude-3-5-sonnet-20240620'),
+}
+PROMPT_MAX_QUESTION_TOKENS = 600  # longer questions are truncated in the middle
+PROMPT_BUDGETS = {
+    'easy': {'max_tokens': 300, 'tier': 'fast'},
+    'medium': {'max_tokens': 500, 'tier': 'fast'},
+    'hard': {'max_tokens': 800, 'tier': 'strong'},
+}
+
+# Outbound HTTP connection pools, one keep-alive pool per upstream service.
+# pool_maxsize should cover the worker's thread/greenlet count.
+HTTP_CLIENT_DEFAULTS = {
+    'pool_connections': 4,
+    'pool_maxsize': int(os.environ.get('HTTP_POOL_MAXSIZE', 10)),
+    'pool_block': False,
+    'connect_timeout': 3.05,
+    'read_timeout': 30,
+}
+HTTP_CLIENTS = {
+    'openai': {'read_timeout': int(os.environ.get('OPENAI_READ_TIMEOUT', 60))},
+    'claude': {'read_timeout': int(os.environ.get('CLAUDE_READ_TIMEOUT', 60))},
+    'mpesa': {'read_timeout': 20},
+}
+
+AI_PROVIDER = os.environ.get('AI_PROVIDER', 'router')
+AI_PROVIDERS = {
+    'openai': 'homework_helper.providers.OpenAIProvider',
+    'claude': 'homework_helper.providers.ClaudeProvider',
+    'router': 'homework_helper.providers.RouterProvider',  # routes between AI_ROUTER_BACKENDS
+    'stub': 'homework_helper.providers.StubProvider',  # offline, for development and tests
+}
+AI_STUB_TOKEN_DELAY = float(os.environ.get('AI_STUB_TOKEN_DELAY', 0))  # seconds between stub tokens
+AI_STREAM_FLUSH_INTERVAL = 2.0  # seconds between partial answer saves while streaming
+
+# Provider router (AI_PROVIDER=router)
+AI_ROUTER_BACKENDS = os.environ.get('AI_ROUTER_BACKENDS', 'openai,claude').split(',')
+AI_ROUTER_WINDOW = 200  # recent requests kept per backend for latency and error stats
+AI_ROUTER_MIN_SAMPLES = 20  # successes needed before latency percentiles are trusted
+AI_ROUTER_HEDGE_DELAY = 8.0  # seconds before hedging while a backend has too few samples
+AI_ROUTER_BREAKER_FAILURES = 5  # consecutive failures that open a backend's circuit
+AI_ROUTER_BREAKER_COOLDOWN = 30  # seconds an open circuit waits before a probe
+AI_ROUTER_MAX_WORKERS = 16
+
+# Image questions
+IMAGE_QUESTION_QUEUE = 'images'  # Celery queue served by the image workers
+IMAGE_MAX_DIMENSION = 1600  # pixels, longer side
+IMAGE_MAX_BYTES = 300 * 1024  # re-encoded JPEG budget
+IMAGE_TEXT_EXTRACTOR = os.environ.get('IMAGE_TEXT_EXTRACTOR', 'stub')
+IMAGE_TEXT_EXTRACTORS = {
+    'stub': 'homework_helper.imaging.StubTextExtractor',  # offline, for development and tests
+    'tesseract': 'homework_helper.imaging.TesseractTextExtractor',
+}
+IMAGE_STUB_TEXT = os.environ.get('IMAGE_STUB_TEXT', '')
+
+# AI answer cache
+ANSWER_CACHE_ALIAS = 'answers'
+ANSWER_CACHE_TIMEOUT = int(os.environ.get('ANSWER_CACHE_TIMEOUT', 60 * 60 * 24 * 30))  # 30 days
+
 # Payment Settings
 MPESA_CONSUMER_KEY = os.environ.get('MPESA_CONSUMER_KEY', '')
 MPESA_CONSUMER_SECRET = os.environ.get('MPESA_CONSUMER_SECRET', '')
 MPESA_SHORTCODE = os.environ.get('MPESA_SHORTCODE', '')
 MPESA_PASSKEY = os.environ.get('MPESA_PASSKEY', '')
+MPESA_BASE_URL = os.environ.get('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke')
+MPESA_CALLBACK_URL = os.environ.get('MPESA_CALLBACK_URL', 'https://yourdomain.com/api/mpesa/callback/')
+MPESA_CALLBACK_BATCH_SIZE = 500  # callbacks applied per transaction
+MPESA_CALLBACK_MAX_ATTEMPTS = 5  # re-queues for callbacks that arrive before their payment is known
+MPESA_TOKEN_EXPIRY_MARGIN = 120  # seconds; refresh the cached OAuth token this long before expiry
+MPESA_TOKEN_LOCK_TIMEOUT = 10  # seconds to wait for another worker's token fetch
+MPESA_STK_MAX_RETRIES = 5
+MPESA_STK_RETRY_BACKOFF = 2  # seconds; doubled on every retry
+MPESA_STK_RETRY_BACKOFF_MAX = 60  # seconds
 
 # Email Settings
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp.gmail.com'
-EMAIL_PORT = 587
-EMAIL_USE_TLS = True
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.gmail.com')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
+EMAIL_TIMEOUT = 10
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
+MAIL_BATCH_SIZE = 200  # messages sent per SMTP connection
+MAIL_BATCH_RATE_LIMIT = os.environ.get('MAIL_BATCH_RATE_LIMIT', '30/m')  # batches per worker
+
+# Notification outbox
+NOTIFICATION_DISPATCH_BATCH = 200
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_CLAIM_TIMEOUT = 600  # seconds before an unconfirmed batch is sent again
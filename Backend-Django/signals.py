@@ -0,0 +1,90 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from . import authentication, blobs, credits, entitlements, rollups
+from .conditional import invalidate_profiles
+from .models import User, Child, Question, Payment, Subscription
+
+ENTITLEMENT_FIELDS = {'subscription_type', 'subscription_status', 'subscription_end_date'}
+
+
+def _invalidate_entitlement_on_commit(user_id):
+    # After commit, so a concurrent read can't re-cache the old state
+    transaction.on_commit(lambda: entitlements.invalidate([user_id]))
+
+
+@receiver(post_save, sender=User)
+def reset_live_credit_balance(sender, instance, created, update_fields=None, **kwargs):
+    # Direct edits to User.credits (admin, support tooling) must reach the live
+    # counter, and a new account must not inherit a counter left under its id
+    if created or update_fields is None or 'credits' in update_fields:
+        # Again after commit: a read before then re-seeds from the old row
+        credits.forget_balance(instance.pk)
+        transaction.on_commit(lambda: credits.forget_balance(instance.pk))
+
+
+@receiver(post_save, sender=User)
+def user_plan_changed(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        # Nothing can have cached the new account yet, except a leftover under its id
+        entitlements.invalidate([instance.pk])
+    elif update_fields is None or ENTITLEMENT_FIELDS & set(update_fields):
+        _invalidate_entitlement_on_commit(instance.pk)
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def billing_changed(sender, instance, **kwargs):
+    _invalidate_entitlement_on_commit(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, **kwargs):
+    # Cached request.user copies must not outlive edits such as is_active
+    if not created:
+        transaction.on_commit(lambda: authentication.invalidate_user(instance.pk))
+
+
+@receiver(post_save, sender=User)
+def profile_changed(sender, instance, created, **kwargs):
+    if not created:
+        transaction.on_commit(lambda: invalidate_profiles([instance.pk]))
+
+
+@receiver(post_save, sender=Child)
+@receiver(post_delete, sender=Child)
+def child_changed(sender, instance, **kwargs):
+    # Children are embedded in the profile and listed under the same version
+    transaction.on_commit(lambda: invalidate_profiles([instance.parent_id]))
+
+
+@receiver(post_save, sender=Child)
+@receiver(pre_delete, sender=Child)
+def child_questions_changed(sender, instance, created=False, **kwargs):
+    # Question bodies show the child's name; move their ETags on. Before a
+    # delete, since SET_NULL clears the link without touching updated_at.
+    if not created:
+        Question.objects.filter(child_id=instance.pk).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    authentication.invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def question_changed(sender, instance, **kwargs):
+    # Schedule the question's day for a rollup rebuild
+    transaction.on_commit(lambda: rollups.mark_dirty(instance.created_at))
+
+
+@receiver(post_delete, sender=Question)
+def question_deleted(sender, instance, **kwargs):
+    if instance.image_blob_id:
+        transaction.on_commit(lambda: blobs.release(instance.image_blob_id))
@@ -0,0 +1,17 @@
+import json
+from rest_framework.renderers import BaseRenderer
+
+
+def format_event(event, data):
+    """Encode one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets DRF negotiate `Accept: text/event-stream` and render errors as an SSE event"""
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_event('error', data)
@@ -0,0 +1,50 @@
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from . import authentication, credits, entitlements
+from .conditional import invalidate_profiles
+from .models import User, Subscription
+
+# Lapsed subscriptions are expired a chunk at a time: each chunk locks at most
+# `batch_size` rows (skipping any another worker holds), issues a few bulk
+# UPDATEs and commits. Expired rows drop out of the active index, so a crashed
+# run simply resumes where it stopped.
+
+
+def expire_batch(now, batch_size=1000):
+    """Expire one chunk of subscriptions that ended before `now`.
+
+    Returns (subscriptions expired, users moved to the free plan).
+    """
+    with transaction.atomic():
+        rows = list(
+            Subscription.objects.select_for_update(skip_locked=True)
+            .filter(status='active', end_date__lt=now)
+            .order_by('end_date')
+            .values_list('id', 'user_id')[:batch_size]
+        )
+        if not rows:
+            return 0, 0
+
+        Subscription.objects.filter(id__in=[row[0] for row in rows]).update(status='expired')
+
+        # Users who have already renewed keep their plan
+        renewed = Subscription.objects.filter(user=OuterRef('pk'), status='active', end_date__gte=now)
+        user_ids = sorted(
+            User.objects.filter(pk__in={row[1] for row in rows})
+            .exclude(Exists(renewed))
+            .values_list('pk', flat=True)
+        )
+        if user_ids:
+            # Ledger rows before User rows, as compact_ledger() takes them
+            credits.reset_balances(user_ids)
+            User.objects.filter(pk__in=user_ids).update(
+                subscription_type='free',
+                subscription_status='expired'
+            )
+
+        # Bulk updates skip the signals that normally drop cached user state
+        changed_users = {row[1] for row in rows}
+        transaction.on_commit(lambda: entitlements.invalidate(changed_users))
+        transaction.on_commit(lambda: authentication.invalidate_users(user_ids))
+        transaction.on_commit(lambda: invalidate_profiles(user_ids))
+    return len(rows), len(user_ids)
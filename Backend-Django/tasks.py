@@ -1,60 +1,192 @@
 from celery import shared_task
-from django.core.mail import send_mail
+from celery.utils.time import get_exponential_backoff_interval
 from django.conf import settings
-from .models import Question, User
-from .services import AIService
+from django.utils import timezone
+from datetime import timedelta
+from . import activity, blobs, credits, mailer, notifications, rollups, subscriptions
+from .models import Question, Payment, Subscription
+from .services import AIService, PaymentService, MpesaTransientError
 
 @shared_task
-def process_question_async(question_id):
+def process_question_async(question_id, use_cache=True):
     """Process question with AI asynchronously"""
     try:
-        question = Question.objects.get(id=question_id)
+        question = Question.objects.select_related('user').get(id=question_id)
         ai_service = AIService()
-        ai_service.process_question(question)
+        ai_service.process_question(question, use_cache=use_cache)
         
-        # Send email notification to user
-        send_mail(
-            subject='Your homework question has been answered!',
-            message=f'''
-            Hi {question.user.first_name},
+    except Question.DoesNotExist:
+        pass
+
+@shared_task(bind=True, max_retries=settings.MPESA_STK_MAX_RETRIES)
+def dispatch_stk_push(self, payment_id):
+    """Send the M-Pesa STK push for a pending payment, retrying transient failures"""
+    try:
+        # A checkout id means the push already went out; don't ring the phone twice
+        payment = Payment.objects.select_related('user').get(
+            id=payment_id, status='pending', checkout_request_id__isnull=True
+        )
+    except Payment.DoesNotExist:
+        return
+    
+    try:
+        PaymentService().process_mpesa_payment(payment)
+    except MpesaTransientError as exc:
+        if self.request.retries >= self.max_retries:
+            # Retry budget spent: give up on this push
+            Payment.objects.filter(id=payment_id, status='pending').update(status='failed')
+            return
+        
+        # Exponential backoff with full jitter so retries don't arrive in waves
+        countdown = get_exponential_backoff_interval(
+            factor=settings.MPESA_STK_RETRY_BACKOFF,
+            retries=self.request.retries,
+            maximum=settings.MPESA_STK_RETRY_BACKOFF_MAX,
+            full_jitter=True
+        )
+        raise self.retry(exc=exc, countdown=countdown)
+
+@shared_task
+def apply_mpesa_callbacks():
+    """Apply queued M-Pesa callbacks in batches until the queue is drained"""
+    payment_service = PaymentService()
+    total = 0
+    while True:
+        applied = payment_service.apply_callbacks()
+        total += applied
+        if applied < settings.MPESA_CALLBACK_BATCH_SIZE:
+            return total
+
+@shared_task
+def compact_credit_ledger():
+    """Fold credit ledger entries into the stored balances"""
+    total = 0
+    while True:
+        compacted = credits.compact_ledger(batch_size=settings.CREDIT_LEDGER_COMPACTION_BATCH)
+        total += compacted
+        if compacted < settings.CREDIT_LEDGER_COMPACTION_BATCH:
+            return total
+
+@shared_task
+def dispatch_notifications():
+    """Send pending outbox notifications, one batch per channel at a time"""
+    sent = {}
+    for channel in notifications.SENDERS:
+        sent[channel] = 0
+        while True:
+            handled = notifications.dispatch(channel)
+            sent[channel] += handled
+            if handled < settings.NOTIFICATION_DISPATCH_BATCH:
+                break
+    return sent
+
+@shared_task
+def process_expired_subscriptions():
+    """Expire lapsed subscriptions in chunks and move their users to the free plan"""
+    now = timezone.now()
+    totals = {'subscriptions': 0, 'users': 0}
+    while True:
+        expired, downgraded = subscriptions.expire_batch(now, batch_size=settings.SUBSCRIPTION_EXPIRY_BATCH_SIZE)
+        totals['subscriptions'] += expired
+        totals['users'] += downgraded
+        if expired < settings.SUBSCRIPTION_EXPIRY_BATCH_SIZE:
+            return totals
+
+@shared_task(rate_limit=settings.MAIL_BATCH_RATE_LIMIT)
+def send_mail_batch(messages):
+    """Send a batch of emails over one SMTP connection"""
+    sent, failed = mailer.send_batch(messages)
+    return {'sent': sent, 'failed': failed}
+
+@shared_task
+def send_subscription_reminders():
+    """Queue renewal reminders for subscriptions expiring in 3 days"""
+    reminder_date = timezone.now() + timedelta(days=3)
+    upcoming_expiries = Subscription.objects.filter(
+        end_date__date=reminder_date.date(),
+        status='active',
+        auto_renew=False
+    ).values_list('user__email', 'user__first_name', 'end_date')
+    
+    queued = 0
+    batch = []
+    for email, first_name, end_date in upcoming_expiries.iterator(chunk_size=settings.MAIL_BATCH_SIZE):
+        batch.append(mailer.message(
+            to=email,
+            subject='Homework Helper Subscription Reminder',
+            body=f'''
+            Hi {first_name},
             
-            Your question about {question.subject} has been processed and answered.
+            Your Homework Helper subscription will expire on {end_date.strftime('%B %d, %Y')}.
             
-            Log in to your Homework Helper app to view the detailed explanation.
+            Don't miss out on getting help with your children's homework!
             
-            Question: {question.content[:100]}...
+            Renew your subscription now to continue enjoying unlimited questions and expert explanations.
             
             Best regards,
             The Homework Helper Team
-            ''',
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[question.user.email],
-            fail_silently=True,
-        )
-        
-    except Question.DoesNotExist:
-        pass
+            '''
+        ))
+        if len(batch) == settings.MAIL_BATCH_SIZE:
+            mailer.queue(batch)
+            queued += len(batch)
+            batch = []
+    if batch:
+        mailer.queue(batch)
+        queued += len(batch)
+    return queued
+
+@shared_task
+def generate_thumbnails(blob_id):
+    """Render thumbnails for a newly stored question image"""
+    return blobs.generate_thumbnails(blob_id)
+
+@shared_task
+def collect_image_blobs():
+    """Delete stored question images that no question references any more"""
+    total = 0
+    while True:
+        deleted = blobs.collect_garbage()
+        total += deleted
+        if not deleted:
+            return total
+
+@shared_task
+def flush_user_activity():
+    """Write recorded activity back to User.last_login in bulk"""
+    return activity.flush_last_seen()
+
+@shared_task
+def refresh_usage_rollups():
+    """Rebuild the daily usage rollups for days with new or changed questions"""
+    return rollups.refresh_rollups()
 
 @shared_task
 def send_daily_usage_report():
     """Send daily usage report to admin"""
-    from django.db.models import Count, Sum
-    from datetime import datetime, timedelta
+    from django.db.models import Sum
+    from datetime import timedelta
+    from django.utils import timezone
+    from .models import DailyUsageRollup
     
-    today = datetime.now().date()
+    today = timezone.localdate()
     yesterday = today - timedelta(days=1)
     
-    # Get statistics
-    daily_questions = Question.objects.filter(created_at__date=yesterday).count()
-    daily_users = User.objects.filter(last_login__date=yesterday).count()
-    daily_revenue = Question.objects.filter(
-        created_at__date=yesterday
-    ).aggregate(total=Sum('cost'))['total'] or 0
+    # Make sure late writes from yesterday are included, then read the rollups
+    rollups.refresh_rollups()
+    totals = DailyUsageRollup.objects.filter(day=yesterday).aggregate(
+        questions=Sum('questions'),
+        revenue=Sum('revenue')
+    )
+    daily_questions = totals['questions'] or 0
+    daily_users = activity.count_active_users(yesterday)
+    daily_revenue = totals['revenue'] or 0
     
     # Send report
-    send_mail(
+    mailer.send_batch([mailer.message(
+        to='admin@homeworkhelper.com',
         subject=f'Homework Helper Daily Report - {yesterday}',
-        message=f'''
+        body=f'''
         Daily Usage Report for {yesterday}
         
         Questions Asked: {daily_questions}
@@ -63,8 +195,5 @@ def send_daily_usage_report():
         
         Best regards,
         System
-        ''',
-        from_email=settings.EMAIL_HOST_USER,
-        recipient_list=['admin@homeworkhelper.com'],
-        fail_silently=True,
-    )
+        '''
+    )])
@@ -5,7 +5,9 @@ urlpatterns = [
     # Authentication
     path('auth/register/', views.UserRegistrationView.as_view(), name='register'),
     path('auth/login/', views.UserLoginView.as_view(), name='login'),
+    path('auth/logout/', views.logout, name='logout'),
     path('auth/profile/', views.UserProfileView.as_view(), name='profile'),
+    path('auth/entitlements/', views.user_entitlements, name='entitlements'),
     
     # Children
     path('children/', views.ChildListCreateView.as_view(), name='children-list'),
@@ -14,11 +16,20 @@ urlpatterns = [
     # Questions
     path('questions/', views.QuestionListCreateView.as_view(), name='questions-list'),
     path('questions/<int:pk>/', views.QuestionDetailView.as_view(), name='question-detail'),
+    path('questions/<int:pk>/image/', views.question_image, name='question-image'),
+    path('questions/<int:pk>/image/<str:size>/', views.question_image, name='question-image'),
+    path('questions/<uuid:question_id>/status/', views.question_status, name='question-status'),
+    path('questions/<uuid:question_id>/stream/', views.stream_question, name='stream-question'),
     path('questions/<uuid:question_id>/rate/', views.rate_question, name='rate-question'),
     
     # Payments
     path('payments/', views.PaymentListCreateView.as_view(), name='payments-list'),
+    path('mpesa/callback/', views.mpesa_callback, name='mpesa-callback'),
     
     # Subscriptions
     path('subscriptions/', views.SubscriptionListCreateView.as_view(), name='subscriptions-list'),
+    
+    # Operations
+    path('system/stats/', views.system_stats, name='system-stats'),
+    path('system/usage/', views.usage_report, name='usage-report'),
 ]
@@ -1,22 +1,42 @@
 from rest_framework import generics, status, permissions
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import (
+    api_view, authentication_classes, permission_classes, renderer_classes, throttle_classes
+)
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import login
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.utils import timezone
 from django.conf import settings
+from django_filters.rest_framework import DjangoFilterBackend
 import requests
 import json
 import base64
 import time
-from datetime import datetime, timedelta
+import uuid
+from datetime import date, datetime, timedelta
+from . import credits, entitlements, notifications, rollups
 from .models import User, Child, Question, Payment, Subscription
 from .serializers import (
     UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer,
-    ChildSerializer, QuestionSerializer, PaymentSerializer, SubscriptionSerializer
+    ChildSerializer, QuestionSerializer, QuestionListSerializer, PaymentSerializer,
+    SubscriptionSerializer, query_param_set
 )
+from . import authentication
+from .activity import record_activity
+from .answer_cache import AnswerCache
+from .conditional import ConditionalGetMixin, profile_version
+from .media import protected_file_response
+from .pagination import HistoryPagination, SubscriptionHistoryPagination
+from .providers import get_provider
 from .services import AIService, PaymentService
+from .streaming import EventStreamRenderer, format_event
+from .tasks import process_question_async, dispatch_stk_push
 
 class UserRegistrationView(generics.CreateAPIView):
     queryset = User.objects.all()
@@ -42,74 +62,205 @@ class UserLoginView(generics.GenericAPIView):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         token, created = Token.objects.get_or_create(user=user)
-        user.last_login = timezone.now()
-        user.save()
+        record_activity(user.pk)
         return Response({
             'user': UserProfileSerializer(user).data,
             'token': token.key
         })
 
-class UserProfileView(generics.RetrieveUpdateAPIView):
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def logout(request):
+    # Deleting the token also drops it from the authentication cache
+    if request.auth is not None:
+        request.auth.delete()
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+class UserProfileView(ConditionalGetMixin, generics.RetrieveUpdateAPIView):
     serializer_class = UserProfileSerializer
     permission_classes = [permissions.IsAuthenticated]
     
+    def get_version(self):
+        return profile_version(self.request.user.pk)
+    
     def get_object(self):
-        return self.request.user
+        # request.user may be a cached copy; read the profile fresh
+        return User.objects.prefetch_related('children').get(pk=self.request.user.pk)
 
-class ChildListCreateView(generics.ListCreateAPIView):
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def user_entitlements(request):
+    return Response(entitlements.get_entitlement(request.user.id, include_balance=True))
+
+class ChildListCreateView(ConditionalGetMixin, generics.ListCreateAPIView):
     serializer_class = ChildSerializer
     permission_classes = [permissions.IsAuthenticated]
     
+    def get_version(self):
+        return profile_version(self.request.user.pk)
+    
     def get_queryset(self):
         return Child.objects.filter(parent=self.request.user)
     
     def perform_create(self, serializer):
         serializer.save(parent=self.request.user)
 
-class ChildDetailView(generics.RetrieveUpdateDestroyAPIView):
+class ChildDetailView(ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = ChildSerializer
     permission_classes = [permissions.IsAuthenticated]
     
+    def get_version(self):
+        return f"{profile_version(self.request.user.pk)}:{self.kwargs['pk']}"
+    
     def get_queryset(self):
         return Child.objects.filter(parent=self.request.user)
 
+def use_answer_cache(request):
+    # Clients can force a fresh answer with ?nocache=1 or Cache-Control: no-cache
+    if request.query_params.get('nocache') in ('1', 'true'):
+        return False
+    return 'no-cache' not in request.headers.get('Cache-Control', '')
+
 class QuestionListCreateView(generics.ListCreateAPIView):
     serializer_class = QuestionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = HistoryPagination
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['difficulty', 'child']
     
     def get_queryset(self):
-        return Question.objects.filter(user=self.request.user)
+        queryset = Question.objects.filter(user=self.request.user).select_related('child', 'image_blob')
+        if self.request.method == 'GET':
+            # Don't load answer bodies the list won't render
+            expand = query_param_set(self.request, 'expand')
+            deferred = [name for name in ('ai_response', 'explanation', 'step_by_step', 'feedback') if name not in expand]
+            queryset = queryset.defer(*deferred)
+        return queryset
     
-    def perform_create(self, serializer):
-        user = self.request.user
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return QuestionListSerializer
+        return QuestionSerializer
+    
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = request.user
+        entitlement = entitlements.get_entitlement(user.id)
         
-        # Check if user has credits or active subscription
-        if user.subscription_type == 'free' and user.credits <= 0:
+        # Free and pay-per-use questions are paid for with credits
+        uses_credits = entitlement['uses_credits']
+        if uses_credits and not credits.debit(user.id):
             return Response(
                 {'error': 'No credits remaining. Please purchase credits or subscribe.'},
                 status=status.HTTP_402_PAYMENT_REQUIRED
             )
         
-        # Calculate cost based on subscription type
-        cost = 0
-        if user.subscription_type == 'pay-per-use':
-            cost = 10  # KES 10 per question
-        elif user.subscription_type == 'free':
-            user.credits -= 1
-            user.save()
+        try:
+            with transaction.atomic():
+                question = self.perform_create(
+                    serializer,
+                    cost=entitlement['cost_per_question'],
+                    plan=entitlement['plan']
+                )
+                if uses_credits:
+                    credits.record(user.id, -1, 'question', question=question)
+        except Exception:
+            if uses_credits:
+                credits.refund(user.id)
+            raise
         
-        question = serializer.save(user=user, cost=cost)
+        return Response({
+            'id': question.id,
+            'question_id': question.question_id,
+            'status': question.status,
+            'status_url': reverse('question-status', args=[question.question_id]),
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    def perform_create(self, serializer, cost=0, plan='free'):
+        question = serializer.save(user=self.request.user, cost=cost, plan=plan)
         
-        # Process question with AI
-        ai_service = AIService()
-        ai_service.process_question(question)
+        # Answer in the background once the question row is committed; image
+        # questions go to their own queue so they can't starve text questions
+        use_cache = use_answer_cache(self.request)
+        options = {'queue': settings.IMAGE_QUESTION_QUEUE} if question.type == 'image' else {}
+        transaction.on_commit(lambda: process_question_async.apply_async(
+            (question.id,), {'use_cache': use_cache}, **options
+        ))
+        return question
+    
 
-class QuestionDetailView(generics.RetrieveUpdateAPIView):
+class QuestionDetailView(ConditionalGetMixin, generics.RetrieveUpdateAPIView):
     serializer_class = QuestionSerializer
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return Question.objects.filter(user=self.request.user)
+        return Question.objects.filter(user=self.request.user).select_related('child', 'image_blob')
+    
+    def get_last_modified(self):
+        # One indexed lookup; the full row is only loaded when it has changed
+        if not hasattr(self, '_updated_at'):
+            self._updated_at = (
+                Question.objects.filter(pk=self.kwargs['pk'], user=self.request.user)
+                .values_list('updated_at', flat=True).first()
+            )
+        return self._updated_at
+    
+    def get_version(self):
+        updated_at = self.get_last_modified()
+        return updated_at.isoformat() if updated_at is not None else None
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def question_status(request, question_id):
+    question = get_object_or_404(
+        Question.objects.only('id', 'question_id', 'status', 'is_processed'),
+        question_id=question_id,
+        user=request.user
+    )
+    response = Response({
+        'id': question.id,
+        'question_id': question.question_id,
+        'status': question.status,
+        'is_processed': question.is_processed,
+    })
+    if question.status != 'done':
+        # Short poll: tell the client when to ask again
+        response['Retry-After'] = '2'
+    return response
+
+@api_view(['GET'])
+@renderer_classes([EventStreamRenderer, JSONRenderer])
+@permission_classes([permissions.IsAuthenticated])
+def stream_question(request, question_id):
+    question = get_object_or_404(Question, question_id=question_id, user=request.user)
+    events = AIService().stream_question(question, use_cache=use_answer_cache(request))
+    
+    response = StreamingHttpResponse(
+        (format_event(event, data) for event, data in events),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # stop nginx from buffering the stream
+    return response
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def question_image(request, pk, size=None):
+    # The ownership check is the only work done here; the web server sends the bytes
+    question = get_object_or_404(
+        Question.objects.select_related('image_blob').only('image', 'image_blob'),
+        pk=pk, user=request.user
+    )
+    if not question.image:
+        raise Http404
+    if size is None:
+        return protected_file_response(question.image.name)
+    
+    thumbnail = question.image_blob.thumbnails.get(size) if question.image_blob else None
+    if thumbnail is None:
+        raise Http404
+    return protected_file_response(thumbnail)
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
@@ -133,21 +284,41 @@ def rate_question(request, question_id):
 class PaymentListCreateView(generics.ListCreateAPIView):
     serializer_class = PaymentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = HistoryPagination
     
     def get_queryset(self):
         return Payment.objects.filter(user=self.request.user)
     
     def perform_create(self, serializer):
-        payment = serializer.save(user=self.request.user)
+        payment = serializer.save(
+            user=self.request.user,
+            transaction_id=f"HH{uuid.uuid4().hex[:16].upper()}"
+        )
         
-        # Process payment based on method
-        payment_service = PaymentService()
+        # Process payment based on method, outside the request
         if payment.payment_method == 'mpesa':
-            payment_service.process_mpesa_payment(payment)
+            transaction.on_commit(lambda: dispatch_stk_push.delay(payment.id))
+
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+@throttle_classes([])
+def mpesa_callback(request):
+    # Acknowledge quickly; the payment updates happen in apply_mpesa_callbacks
+    try:
+        PaymentService().enqueue_callback(request.data)
+    except (ParseError, ValueError):
+        # Still answer in the shape Daraja expects
+        return Response(
+            {'ResultCode': 1, 'ResultDesc': 'Malformed callback'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return Response({'ResultCode': 0, 'ResultDesc': 'Accepted'})
 
 class SubscriptionListCreateView(generics.ListCreateAPIView):
     serializer_class = SubscriptionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = SubscriptionHistoryPagination
     
     def get_queryset(self):
         return Subscription.objects.filter(user=self.request.user)
@@ -167,5 +338,34 @@ class SubscriptionListCreateView(generics.ListCreateAPIView):
         user = self.request.user
         user.subscription_type = plan_type
         user.subscription_end_date = end_date
-        user.save()    
+        user.save(update_fields=['subscription_type', 'subscription_end_date'])
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def system_stats(request):
+    return Response({
+        'answer_cache': AnswerCache().stats(),
+        'auth_cache': authentication.get_stats(),
+        'notification_queue': notifications.queue_depth(),
+        # Router stats are per process: this web worker's view of the backends
+        'ai_providers': getattr(get_provider(), 'describe', dict)(),
+    })
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def usage_report(request):
+    try:
+        end = date.fromisoformat(request.query_params.get('end', timezone.localdate().isoformat()))
+        start = date.fromisoformat(request.query_params.get('start', (end - timedelta(days=30)).isoformat()))
+    except ValueError:
+        return Response(
+            {'error': 'Dates must be in YYYY-MM-DD format'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    days = rollups.usage_summary(start, end)
+    for day in days:
+        processed = day.pop('processed_questions')
+        total_time = day.pop('processing_time_total')
+        day['average_processing_time'] = round(total_time / processed) if processed else None
+    return Response({'start': start, 'end': end, 'days': days})